@@ -6,7 +6,12 @@ import sys
 import hashlib
 import struct
 import math
-from worldmap import WorldMap, MapGrid
+import time
+import functools
+import collections
+import multiprocessing
+import os
+from worldmap import WorldMap, MapGrid, derive_seed
 import ips
 from os import sep as os_sep
 
@@ -20,6 +25,52 @@ prg0sums = ['6a50ce57097332393e0e8751924fd56456ef083c',  # Dragon Warrior (U) (P
             '6e1a52b7b3a13494536bbab7248690861665001a',  # Dragon Warrior (U) (PRG0) [o2].nes
             '3077d5bd5c5c3744398b122d5ee1bba7055c8d45']  # Dragon Warrior (U) (PRG0) [o3].nes
 prg1sums = ['1ecc63aaac50a9612eaa8b69143858c3e48dd0ae']  # Dragon Warrior (U) (PRG1) [!].nes
+# Seed schemes. Scheme 1 draws everything from the global random stream, in
+# order. Scheme 2 gives each stage its own stream derived from the seed and
+# the name of the stage, and seeds each map generation attempt separately.
+SEED_SCHEMES = (1, 2)
+
+
+def stage(name):
+    """
+    Marks a Rom method as a randomization stage. The patch records it adds
+    are labelled with its name, as with patches.
+
+    :Parameters:
+      name : string
+        The name of the stage. With seed scheme 2, this is combined with the
+        seed to create the random number generator used by the stage.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.seed_scheme >= 2:
+                self.rng = random.Random(derive_seed(self.seed, name))
+                self.owmap.rng = self.rng
+            return method(self, *args, **kwargs)
+        return patches(name)(wrapper)
+    return decorator
+
+
+def patches(name):
+    """
+    Labels the patch records added by a Rom method with a name, so that
+    Rom.commit can tell which methods overwrite each other.
+
+    :Parameters:
+      name : string
+        The label for the records.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            label, self.patch.label = self.patch.label, name
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.patch.label = label
+        return wrapper
+    return decorator
 
 
 class Rom:
@@ -57,10 +108,39 @@ class Rom:
     encounter_enemies_slice = slice(0xcd74, 0xcdaf, 29)
     encounter_2_kill_slice = slice(0xe97e, 0xe985, 6)  # green dragon
     encounter_3_kill_slice = slice(0xe990, 0xe997, 6)  # golem
-
-    def __init__(self, filename):
-        with open(filename, 'rb') as input_file:
-            self.rom_data = bytearray(input_file.read())
+    # the tables revert() copies from the unmodified rom, by attribute name
+    base_tables = {
+        "enemy_stats": enemy_stats_slice,
+        "mp_reqs": mp_req_slice,
+        "xp_reqs": xp_req_slice,
+        "zones": zones_slice,
+        "zone_layout": zone_layout_slice,
+        "shop_inventory": weapon_shop_inv_slice,
+        "token_loc": token_slice,
+        "flute_loc": flute_slice,
+        "armor_loc": armor_slice,
+        "encounter_1_loc": encounter_1_slice,  # axe knight
+        "encounter_2_loc": encounter_2_slice,  # green dragon
+        "encounter_3_loc": encounter_3_slice,  # golem
+        "encounter_enemies": encounter_enemies_slice,
+        # set position 1 to these to disable remembering of killing them.
+        "encounter_2_kill": encounter_2_kill_slice,
+        "encounter_3_kill": encounter_3_kill_slice,
+        "player_stats": player_stats_slice,
+        "new_spell_levels": new_spell_slice,
+        "chests": chests_slice,
+        "title_screen_text": title_text_slice,
+    }
+
+    def __init__(self, filename, seed=None, seed_scheme=1, data=None):
+        if data is None:
+            with open(filename, 'rb') as input_file:
+                data = input_file.read()
+        self.rom_data = bytearray(data)
+        self.base = rom_base(bytes(self.rom_data))  # the rom as loaded
+        self.seed = seed
+        self.seed_scheme = seed_scheme
+        self.rng = random  # the random number generator for the current stage
         self.revert()
 
     def sha1(self, data=None):
@@ -109,6 +189,7 @@ class Rom:
         """
         return ''.join([self.alphabet[i] for i in list(dialogue)])
 
+    @stage("chests")
     def shuffle_chests(self):
         """
         Shuffles the contents of all chests in the game. Checks are used to ensure no
@@ -122,7 +203,7 @@ class Rom:
                 chest_contents[i] = 21
             # 50/50 chance to have erdrick's token in a chest. If not, large gold.
             if chest_contents[i] == 0x17:
-                if random.randint(0, 1):
+                if self.rng.randint(0, 1):
                     self.token_loc[0] = 0  # remove token from the ground
                     chest_contents[i] = 10  # put it in a chest
                 else:
@@ -130,7 +211,7 @@ class Rom:
 
         staff_index = chest_contents.index(0x10)
         chest_contents.remove(0x10)  # don't shuffle the staff
-        random.shuffle(chest_contents)
+        self.rng.shuffle(chest_contents)
         chest_contents.insert(staff_index, 0x10)  # put the staff back in the array
 
         # make sure required quest items aren't in Charlock
@@ -151,10 +232,10 @@ class Rom:
         if not (3 in chest_contents[4:7]):
             for i in range(len(chest_contents)):
                 if chest_contents[i] == 3:
-                    j = random.randint(4, 6)
+                    j = self.rng.randint(4, 6)
                     # if key is in charlock and chest[j] contains a quest item, try again
                     while i in charlock_chest_indices and (chest_contents[j] in quest_items):
-                        j = random.randint(4, 6)
+                        j = self.rng.randint(4, 6)
                     chest_contents[j], chest_contents[i] = chest_contents[i], chest_contents[j]
                     break
 
@@ -167,12 +248,13 @@ class Rom:
         rtype: int
         return: A chest index that is not in Charlock.
         """
-        chest = random.randint(0, 23)
+        chest = self.rng.randint(0, 23)
         # avoid 11-16 and chest 24 (they are in charlock)
         chest = chest + 6 if (chest > 10) else chest
         chest = chest + 1 if (chest > 23) else chest
         return chest
 
+    @stage("attack_patterns")
     def randomize_attack_patterns(self, ultra=False):
         """
         Randomizes attack patterns of enemies (whether or not they use spells/fire
@@ -190,24 +272,24 @@ class Rom:
         new_ss_resist = self.enemy_stats[4::16]
         for i in range(38):
             new_ss_resist[i] |= 0xf  # max out the lower byte
-            if random.randint(0, 1):  # 50/50 chance
-                resist = random.randint(0, round(i / 5))
+            if self.rng.randint(0, 1):  # 50/50 chance
+                resist = self.rng.randint(0, round(i / 5))
                 new_ss_resist[i] &= (0xf0 | resist)  # set the lower byte to the value of resist.
                 if ultra:
-                    new_patterns.append((random.randint(0, 255)))  # totally random attack pattern.
+                    new_patterns.append((self.rng.randint(0, 255)))  # totally random attack pattern.
                 else:
                     if i <= 20:
                         # heal, sleep, stopspell, hurt
-                        new_patterns.append((random.randint(0, 11) << 4) | random.randint(0, 3))
+                        new_patterns.append((self.rng.randint(0, 11) << 4) | self.rng.randint(0, 3))
                     elif i < 30:
                         # healmore, heal, sleep, stopspell, fire breath, hurtmore
-                        new_patterns.append((random.randint(0, 15) << 4) | random.randint(4, 11))
+                        new_patterns.append((self.rng.randint(0, 15) << 4) | self.rng.randint(4, 11))
                     else:
                         # healmore, sleep, stopspell, strong fire breath, fire breath, hurtmore
                         # we'll be nice and not give Axe Knight Dragonlord's breath.
-                        slot2 = random.randint(4, 11) if i == 33 else random.randint(4, 15)
-                        new_patterns.append((random.choice((0, 1, 3)) << 6) |
-                                            (random.randint(0, 3) << 4) | slot2)
+                        slot2 = self.rng.randint(4, 11) if i == 33 else self.rng.randint(4, 15)
+                        new_patterns.append((self.rng.choice((0, 1, 3)) << 6) |
+                                            (self.rng.randint(0, 3) << 4) | slot2)
             else:
                 new_patterns.append(0)  # fight only
         new_patterns.append(87)  # Dragonlord form 1
@@ -215,6 +297,7 @@ class Rom:
         self.enemy_stats[3::16] = bytearray(new_patterns)
         self.enemy_stats[4::16] = bytearray(new_ss_resist)
 
+    @stage("towns")
     def shuffle_towns(self):
         """
         Shuffles the locations of towns on the map.
@@ -229,23 +312,45 @@ class Rom:
         if not self.owmap.generate():
             self.owmap.revert()
             return False
+        self.update_map_encounters()
+        return True
+
+    def generate_map_parallel(self, seed, workers=1):
+        """
+        Generates a new overworld map, deriving the seed for each attempt from
+        the given seed and making attempts in parallel.
+
+        :Parameters:
+          seed : int
+            The random seed for this ROM.
+          workers : int
+            The number of processes to generate maps in.
+        """
+        self.owmap.generate_parallel(seed, workers)
+        self.update_map_encounters()
+
+    def update_map_encounters(self):
+        """
+        Updates the fixed encounters for a newly generated map.
+        """
         # Stick encounter 3 in Charlock for now...
         self.encounter_3_loc = (6, 25, 22)
         self.encounter_3_kill[1] = self.encounter_3_loc[0]
         # Let's not remember killing it...
         self.encounter_3_kill[1] = 0
-        return True
 
+    @stage("music")
     def shuffle_music(self):
         print("Shuffling music...")
         music_choice = (((1, 2, 3, 4, 5, 15, 16) * 3) + 
                         (6, 7, 8, 9, 10, 11, 12, 13, 14))
-        new_music = bytearray([random.choice(music_choice) for _ in range(29)])
+        new_music = bytearray([self.rng.choice(music_choice) for _ in range(29)])
         music_ips = ips.Patch()
         music_ips.add_record(0x31bf, new_music)
         self.add_patch(0x31bf, new_music)
         music_ips.apply(self.rom_data)
 
+    @patches("music")
     def disable_music(self):
         music_ips = ips.Patch()
         music_ips.add_record(0x31bf, 0, 29)
@@ -258,7 +363,7 @@ class Rom:
         """
         # create a list so one zone doesn't dominate
         zones = list(range(3, 16)) * 5  # 65 items - close enough.
-        random.shuffle(zones)
+        self.rng.shuffle(zones)
         for i in range(len(self.zone_layout)):
             self.zone_layout[i] = zones.pop() << 4 | zones.pop()
         # set tantegel's zone to 0
@@ -294,6 +399,7 @@ class Rom:
             self.zone_layout[zone_index // 2] |= (0xf0 & (value << 4))
         return True
 
+    @stage("zones")
     def randomize_zones(self, ultra=False):
         """
         Randomizes which enemies are present in each zone.
@@ -313,57 +419,58 @@ class Rom:
                 self.randomize_zone_layout()
             # zone 0
             for i in range(0, 5):
-                new_zones.append(random.randint(0, 6))
+                new_zones.append(self.rng.randint(0, 6))
             # zone 1-2
             for i in range(0, 10):
-                new_zones.append(random.randint(0, 14))
+                new_zones.append(self.rng.randint(0, 14))
             # zones 3-15
             for i in range(0, 65):
-                new_zones.append(random.randint(0, 37))
+                new_zones.append(self.rng.randint(0, 37))
             # zones 16-18 (Charlock)
             for i in range(0, 15):
-                new_zones.append(random.randint(29, 37))
+                new_zones.append(self.rng.randint(29, 37))
             # zone 19
             for i in range(0, 5):
-                new_zones.append(random.randint(0, 37))
+                new_zones.append(self.rng.randint(0, 37))
 
             # randomize forced encounter enemies:
             # Golem, Axe Knight, Blue Dragon, Stoneman, Armored Knight, Red Dragon
             for i in range(3):
-                self.encounter_enemies[i] = random.choice((24, 33, 34, 35, 36, 37))
+                self.encounter_enemies[i] = self.rng.choice((24, 33, 34, 35, 36, 37))
             self.encounter_2_kill[0] = self.encounter_enemies[1]
             self.encounter_3_kill[0] = self.encounter_enemies[2]
         else:
             # zone 0
             for j in range(5):
-                new_zones.append(int(random.randint(0, 6) / 2))
+                new_zones.append(int(self.rng.randint(0, 6) / 2))
 
             # zones 1-13 (Overworld)
             for i in range(1, 14):
                 for j in range(5):
-                    enemy = random.randint(i * 2 - 2, min(37, round(i * 3)))
+                    enemy = self.rng.randint(i * 2 - 2, min(37, round(i * 3)))
                     while enemy == 24:  # don't add golem
-                        enemy = random.randint(i * 2 - 2, min(37, round(i * 3)))
+                        enemy = self.rng.randint(i * 2 - 2, min(37, round(i * 3)))
                     new_zones.append(enemy)
 
             # zone 14 - Garin's Grave?
             for j in range(5):
-                new_zones.append(random.randint(7, 17))
+                new_zones.append(self.rng.randint(7, 17))
 
             # zone 15 - Lower Garin's Grave
             for j in range(5):
-                new_zones.append(random.randint(15, 23))
+                new_zones.append(self.rng.randint(15, 23))
 
             # zone 16-18 - Charlock
             for i in range(16, 19):
                 for j in range(5):
-                    new_zones.append(random.randint(13 + i, 37))
+                    new_zones.append(self.rng.randint(13 + i, 37))
 
             # zone 19 - Rimuldar Tunnel
             for j in range(5):
-                new_zones.append(random.randint(3, 11))
+                new_zones.append(self.rng.randint(3, 11))
         self.zones = new_zones
 
+    @stage("shops")
     def randomize_shops(self):
         """
         Randomizes the items available in each weapon shop
@@ -375,16 +482,16 @@ class Rom:
         for i in range(7):
             this_shop = []
             while (len(this_shop) < 5):
-                new_item = random.choice(weapons)
+                new_item = self.rng.choice(weapons)
                 if not new_item in this_shop:
                     this_shop.append(new_item)
             new_shop_inv.append(this_shop)
 
         # add an extra item to one shop since we have 36 slots.
-        six_item_shop = random.randint(0, 6)
-        new_item = random.choice(weapons)
+        six_item_shop = self.rng.randint(0, 6)
+        new_item = self.rng.choice(weapons)
         while new_item in new_shop_inv[six_item_shop]:
-            new_item = random.choice(weapons)
+            new_item = self.rng.choice(weapons)
         new_shop_inv[six_item_shop].append(new_item)
 
         # create the bytearray to insert into the rom. Shops are separated by an
@@ -394,6 +501,7 @@ class Rom:
             shop.sort()
             self.shop_inventory += shop + [0xfd]
 
+    @stage("searchables")
     def shuffle_searchables(self):
         """
         Shuffles the 3 searchable items in the game. (E.Armor, F.Flute, E.Token)
@@ -401,16 +509,19 @@ class Rom:
         print("Shuffling searchable item locations...")
         # move the token, then shuffle
         tantegel = self.owmap.warps_from[self.owmap.tantegel_warp][1:3]
-        grid = MapGrid(self.owmap.grid)
-        new_token_loc = self.owmap.accessible_land(grid, tuple(tantegel))
+        if self.owmap.map_grid is None:
+            self.owmap.map_grid = MapGrid(self.owmap.grid)
+        new_token_loc = self.owmap.accessible_land(self.owmap.map_grid,
+                                                   tuple(tantegel))
         self.token_loc[1:3] = new_token_loc
 
         searchables = [self.token_loc, self.flute_loc, self.armor_loc]
-        random.shuffle(searchables)
+        self.rng.shuffle(searchables)
         self.token_loc = searchables[0]
         self.flute_loc = searchables[1]
         self.armor_loc = searchables[2]
 
+    @stage("growth")
     def randomize_growth(self, ultra=False):
         """
         Randomizes player growth.
@@ -431,19 +542,19 @@ class Rom:
 
         if ultra:
             # set these to make DL normally beatable at lvl 15
-            player_str = inverted_power_curve(4, 155, 1.18)
-            player_agi = inverted_power_curve(4, 145, 1.32)
-            player_hp = inverted_power_curve(10, 230, 0.98)
-            player_mp = inverted_power_curve(0, 220, 0.95)
+            player_str = inverted_power_curve(4, 155, 1.18, rng=self.rng)
+            player_agi = inverted_power_curve(4, 145, 1.32, rng=self.rng)
+            player_hp = inverted_power_curve(10, 230, 0.98, rng=self.rng)
+            player_mp = inverted_power_curve(0, 220, 0.95, rng=self.rng)
         else:
             for i in range(len(player_str)):
-                player_str[i] = round(player_str[i] * random.uniform(0.8, 1.2))
+                player_str[i] = round(player_str[i] * self.rng.uniform(0.8, 1.2))
             for i in range(len(player_agi)):
-                player_agi[i] = round(player_agi[i] * random.uniform(0.8, 1.2))
+                player_agi[i] = round(player_agi[i] * self.rng.uniform(0.8, 1.2))
             for i in range(len(player_hp)):
-                player_hp[i] = round(player_hp[i] * random.uniform(0.8, 1.2))
+                player_hp[i] = round(player_hp[i] * self.rng.uniform(0.8, 1.2))
             for i in range(len(player_mp)):
-                player_mp[i] = round(player_mp[i] * random.uniform(0.8, 1.2))
+                player_mp[i] = round(player_mp[i] * self.rng.uniform(0.8, 1.2))
 
         player_str.sort()
         player_agi.sort()
@@ -455,6 +566,7 @@ class Rom:
         self.player_stats[2:180:6] = player_hp
         self.player_stats[3:180:6] = player_mp
 
+    @stage("spell_learning")
     def randomize_spell_learning(self, ultra=False):
         """
         Randomizes the level at which spells are learned.
@@ -471,10 +583,10 @@ class Rom:
         # choose the levels for new spells
         if ultra:
             for i in range(len(self.new_spell_levels)):
-                self.new_spell_levels[i] = random.randint(0, 16)
+                self.new_spell_levels[i] = self.rng.randint(0, 16)
         else:
             for i in range(len(self.new_spell_levels)):
-                self.new_spell_levels[i] += random.randint(-2, 2)
+                self.new_spell_levels[i] += self.rng.randint(-2, 2)
         self.update_spell_masks()
 
     def update_spell_masks(self):
@@ -529,7 +641,7 @@ class Rom:
 
     #    if ultra:
     #      for i in range(10):
-    #        self.mp_reqs[i] = random.randint(1, 8)
+    #        self.mp_reqs[i] = self.rng.randint(1, 8)
 
     def lower_xp_reqs(self, ultra=False):
         """
@@ -543,6 +655,7 @@ class Rom:
         xp = [round(x * percent) for x in xp]
         self.xp_reqs = struct.pack("<HHHHHHHHHHHHHHHHHHHHHHHHHHHHHH", *xp)
 
+    @stage("enemy_hp")
     def update_enemy_hp(self):
         """
         Updates HP of enemies to that of the remake, where possible.
@@ -553,7 +666,7 @@ class Rom:
                      18, 33, 39, 3, 33, 37, 35, 44, 37, 40, 40, 153, 35,
                      47, 48, 38, 70, 72, 74, 65, 67, 98, 135, 99, 106, 100, 165]
         # randomize Dragonlord's second form HP somewhat
-        remake_hp[-1] -= random.randint(0, 15)  # 150 - 165
+        remake_hp[-1] -= self.rng.randint(0, 15)  # 150 - 165
         self.enemy_stats[2::16] = bytearray(remake_hp)
 
     def move_repel(self):
@@ -567,43 +680,47 @@ class Rom:
             self.new_spell_levels[7] = 8
             self.update_spell_masks()
 
+    def reset(self, seed=None):
+        """
+        Restores the ROM to the state it was loaded in and reverts, so it can
+        be randomized again without reloading it.
+
+        :Parameters:
+          seed : int
+            The seed to be used for the next randomization.
+        """
+        self.rom_data[:] = self.base.rom_data
+        self.seed = seed
+        self.rng = random
+        self.revert()
+
     def revert(self):
         """
         Reverts all previous changes to the ROM
         """
-        self.patch = ips.Patch()
-        self.owmap = WorldMap(self.rom_data)
-        self.enemy_stats = self.rom_data[self.enemy_stats_slice]
-        self.mp_reqs = self.rom_data[self.mp_req_slice]
-        self.xp_reqs = self.rom_data[self.xp_req_slice]
-        self.zones = self.rom_data[self.zones_slice]
-        self.zone_layout = self.rom_data[self.zone_layout_slice]
-        self.shop_inventory = self.rom_data[self.weapon_shop_inv_slice]
-        self.token_loc = self.rom_data[self.token_slice]
-        self.flute_loc = self.rom_data[self.flute_slice]
-        self.armor_loc = self.rom_data[self.armor_slice]
-        self.encounter_1_loc = self.rom_data[self.encounter_1_slice]  # axe knight
-        self.encounter_2_loc = self.rom_data[self.encounter_2_slice]  # green dragon
-        self.encounter_3_loc = self.rom_data[self.encounter_3_slice]  # golem
-        self.encounter_enemies = self.rom_data[self.encounter_enemies_slice]
-        # set position 1 to these to disable remembering of killing them.
-        self.encounter_2_kill = self.rom_data[self.encounter_2_kill_slice]
-        self.encounter_3_kill = self.rom_data[self.encounter_3_kill_slice]
-        self.player_stats = self.rom_data[self.player_stats_slice]
-        self.new_spell_levels = self.rom_data[self.new_spell_slice]
-        self.chests = self.rom_data[self.chests_slice]
-        self.title_screen_text = self.rom_data[self.title_text_slice]
+        self.patch = self.base.patch.copy()
+        self.patch.label = None
+        self.owmap = self.base.owmap.copy()
+        # Rejecting terrain early skips random numbers, and sharing rows keeps
+        # maps that used to be rejected, so seed scheme 1 does without them to
+        # generate the same maps as earlier versions.
+        self.owmap.compact_encoding = self.owmap.early_exit = \
+            self.seed_scheme >= 2
+        for name, table in self.base.tables.items():
+            setattr(self, name, bytearray(table))
 
-        print("Buffing HEAL and HURT slightly...")
-        print("Fixing functionality of the fighter's ring (+%d atk)..."
-              % Rom.ring_power)
-        print("Adding a new throne room exit...")
-        print("Bumping encounter rate for zone 0...")
+    @classmethod
+    def fixed_patches(cls):
+        """
+        Returns the patches which are applied to every randomized ROM.
 
+        rtype: dict
+        return: The patches, in the form addr: value.
+        """
         # patch format - address: (*data)
-        rp = self.ring_power
+        rp = cls.ring_power
         # fighter's ring fix
-        self.add_patches({
+        return {
             # fighter's ring fix
             # 0xf119: (0x4c, 0x7d, 0xff),
             0xf10c: (0x20, 0x7d, 0xff, 0xea),
@@ -651,8 +768,9 @@ class Rom:
             0xe75d: 9,  # buff the hurt spell
             0xdbd1: 18,  # buff the heal spell
             0xea51: (0xad, 0x07, 0x01, 0xea, 0xea),
-        })
+        }
 
+    @patches("death_necklace")
     def death_necklace(self):
         """
         Adds functionality to the death necklace (+10 ATK and -25% HP).
@@ -687,6 +805,7 @@ class Rom:
         })
 
 
+    @patches("menu_wrap")
     def menu_wrap(self):
         print("Enabling menu wraparound...")
         self.add_patches({  # implement up/down wraparound for most menus (from @gameboy9)
@@ -776,6 +895,7 @@ class Rom:
             )
         })
 
+    @patches("speed_hacks")
     def speed_hacks(self):
         """
         Adds some hacks to speed up the game play
@@ -812,6 +932,7 @@ class Rom:
         self.add_patch(0xdb49, 0xea, 6)
         self.add_patch(0xdb54, 0xea, 9)
 
+    @patches("auto_stairs")
     def auto_stairs(self):
         """
         Makes stairs automatic (no need for the stairs command)
@@ -859,6 +980,7 @@ class Rom:
                 (("From Tantegel Castle travel %d leagues %s and %d to the %s.         ") %
                  (abs(dy), north_south, abs(dx), east_west))[:71]))
 
+    @patches("finalize")
     def finalize(self):
         """
         Finalizes the IPS.
@@ -890,11 +1012,23 @@ class Rom:
         self.add_patch(self.new_spell_slice, self.new_spell_levels)
         self.add_patch(self.chests_slice, self.chests)
 
-    def commit(self):
+    def commit(self, strict=False):
         """
-        Commits all changes to the ROM
+        Commits all changes to the ROM. The patch is merged into records that
+        don't overlap, and a warning is printed wherever a change overwrites
+        a different one made elsewhere.
+
+        :Parameters:
+          strict : bool
+            Raise an ips.PatchConflict instead of printing a warning.
         """
         self.patch.combine(self.owmap.patch)
+        conflicts = []
+        self.patch = self.patch.merge(conflicts, strict)
+        for start, end, label, overwritten_label in conflicts:
+            print("Warning: %s overwrites %s at 0x%x-0x%x" %
+                  (label, overwritten_label or "an unlabelled patch",
+                   start, end - 1))
         self.patch.apply(self.rom_data)
 
     def add_patch(self, addr, values, size=None):
@@ -942,6 +1076,7 @@ class Rom:
             else:
                 outputfile.write(self.rom_data)
 
+    @patches("title_screen")
     def update_title_screen(self, seed, flags):
         """
         Adds flags and seed number to the title screen
@@ -989,12 +1124,48 @@ class Rom:
         self.add_patch(self.title_text_slice, self.title_screen_text)
 
 
-def inverted_power_curve(min_, max_, power, count=30):
+class RomBase:
+    """
+    The parsed contents of an unmodified ROM, which Rom.revert copies from.
+    This is computed once per input ROM and shared by every Rom made from it,
+    so none of it should be changed.
+    """
+
+    def __init__(self, rom_data):
+        self.rom_data = bytes(rom_data)
+        self.tables = {name: bytes(rom_data[table_slice])
+                       for name, table_slice in Rom.base_tables.items()}
+        self.owmap = WorldMap(bytearray(rom_data))
+        self.patch = ips.Patch(label="fixes")
+        self.patch.add_records(Rom.fixed_patches())
+        print("Buffing HEAL and HURT slightly...")
+        print("Fixing functionality of the fighter's ring (+%d atk)..."
+              % Rom.ring_power)
+        print("Adding a new throne room exit...")
+        print("Bumping encounter rate for zone 0...")
+
+
+@functools.lru_cache(maxsize=4)
+def rom_base(rom_data):
+    """
+    Returns the RomBase for the given ROM contents, parsing them only the
+    first time they are seen.
+
+    :Parameters:
+      rom_data : bytes
+        The contents of an unmodified ROM.
+
+    rtype: RomBase
+    """
+    return RomBase(rom_data)
+
+
+def inverted_power_curve(min_, max_, power, count=30, rng=random):
     range_ = max_ - min_
     p_range = range_ ** (1 / power)
     points = []
     for i in range(count):
-        points.append(round(max_ - ((random.random() * p_range) ** power)))
+        points.append(round(max_ - ((rng.random() * p_range) ** power)))
     points.sort()
     return points
 
@@ -1010,6 +1181,11 @@ def parse_args():
                         help="Enable Death Necklace functionality (+10 ATK -25%% HP)")
     parser.add_argument("--ips", action="store_true",
                         help="Also create an IPS patch for the original ROM")
+    parser.add_argument("--format", choices=("ips", "bps"),
+                        help="Also create a patch for the original ROM in this "
+                             "format (--ips is the same as --format ips). A "
+                             "BPS patch is usually smaller; the size of both "
+                             "is printed.")
     parser.add_argument("-f", "--fast-leveling", action="store_true",
                         help="Set XP requirements for each level to 75%% of normal.")
     parser.add_argument("-F", "--very-fast-leveling", action="store_true",
@@ -1031,6 +1207,10 @@ def parse_args():
                         help="Enable menu wrap-around (experimental)")
     parser.add_argument("--no-map", action="store_true",
                         help="Do not generate a new world map.")
+    parser.add_argument("--map-workers", type=int, default=0,
+                        help="Seed each world map attempt separately and generate this many "
+                             "at once in parallel. The map is the same for any number of workers, "
+                             "but differs from the one generated without this option.")
     parser.add_argument("-o", "--output-dir", type=str, default="",
                         help="The directory where the randomized ROM will be written")
     parser.add_argument("-p", "--no-patterns", action="store_true",
@@ -1042,8 +1222,18 @@ def parse_args():
                              "other tunes, such as the flute, death music, victory music, etc., still play.")
     parser.add_argument("-s", "-S", "--seed", type=int,
                         help="Specify a seed to be used for randomization.")
+    parser.add_argument("-b", "--batch", type=parse_seeds,
+                        help="Randomize once for each seed in a list of seeds and ranges, "
+                             "e.g. 1-1000,1500. The ROM is only loaded once.")
+    parser.add_argument("--batch-workers", type=int, default=1,
+                        help="With --batch, randomize this many seeds at once in separate processes.")
     parser.add_argument("-M", "--ultra-spells", action="store_true",
                         help="Enable ultra randomization of the level spells are learned.")
+    parser.add_argument("--seed-scheme", type=int, choices=SEED_SCHEMES, default=1,
+                        help="The seed scheme to use. 1 (the default) reproduces seeds from "
+                             "earlier versions, unless --map-workers is used. 2 gives each "
+                             "randomization stage and map attempt its own random stream, so "
+                             "changing one option doesn't affect the others.")
     parser.add_argument("-t", "-T", "--no-towns", action="store_true",
                         help="Do not randomize towns.")
     parser.add_argument("-w", "-W", "--no-shops", action="store_true",
@@ -1062,26 +1252,56 @@ def parse_args():
     return parser.parse_args()
 
 
+def parse_seeds(text):
+    """
+    Parses a list of seeds and seed ranges, such as "1-100,250,300-310".
+
+    :Parameters:
+      text : string
+        The seeds to parse. Ranges include both ends.
+
+    rtype: list
+    return: The seeds, in the order given.
+    """
+    seeds = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition('-')
+        if not first.isdecimal() or (dash and not last.isdecimal()):
+            raise argparse.ArgumentTypeError(
+                "'%s' is not a seed or a range of seeds" % part)
+        if dash and int(last) < int(first):
+            raise argparse.ArgumentTypeError(
+                "the seed range '%s' is backwards" % part)
+        seeds.extend(range(int(first), int(last or first) + 1))
+    if not seeds:
+        raise argparse.ArgumentTypeError("no seeds were given")
+    return seeds
+
+
 def main():
     args = parse_args()
     if not (len(args.filename)):
         print("\nThe filename of the ROM is required.")
         sys.exit(-1)
 
-    randomize(args)
+    if args.batch:
+        batch(args)
+    else:
+        randomize(args)
 
 
-def randomize(args):
-    print("\n\nDWRandomizer %s" % VERSION)
+def load_rom(args):
+    """
+    Loads and verifies the ROM named in args.
 
-    if not args.seed:
-        args.seed = random.randint(0, sys.maxsize)
-    print("Randomizing %s using random seed %d..." % (args.filename, args.seed))
-    random.seed(args.seed)
-    flags = ""
+    rtype: tuple
+    return: The Rom and the PRG prefix for output filenames.
+    """
     prg = ""
-
-    rom = Rom(args.filename)
+    rom = Rom(args.filename, args.seed, args.seed_scheme)
 
     print("Verifying checksum...")
     result = rom.verify_checksum()
@@ -1091,12 +1311,137 @@ def randomize(args):
     else:
         print("Processing Dragon Warrior PRG%d ROM..." % result)
         prg = "PRG%d." % result
+    return rom, prg
+
+
+def randomize(args):
+    print("\n\nDWRandomizer %s" % VERSION)
+
+    if not args.seed:
+        args.seed = random.randint(0, sys.maxsize)
+    print("Randomizing %s using random seed %d..." % (args.filename, args.seed))
+    random.seed(args.seed)
+
+    rom, prg = load_rom(args)
+    write_rom(rom, args, prg, *randomize_rom(rom, args))
+
+
+def batch(args):
+    """
+    Randomizes the ROM once for each seed in args.batch. The ROM is only
+    loaded and verified once, and is reset between seeds. The map generation
+    attempts for all of the seeds are counted in the summary.
+    """
+    print("\n\nDWRandomizer %s" % VERSION)
+    seeds = args.batch
+    args.seed = None
+    rom, prg = load_rom(args)
+    map_stats = collections.Counter()
+    start = time.time()
+    if args.batch_workers > 1:
+        farm(rom, args, prg, seeds, map_stats)
+    else:
+        for seed in seeds:
+            print("Randomizing %s using random seed %d..." % (args.filename, seed))
+            args.seed = seed
+            random.seed(seed)
+            rom.reset(seed)
+            write_rom(rom, args, prg, *randomize_rom(rom, args))
+            map_stats.update(rom.owmap.generate_stats)
+    elapsed = time.time() - start
+    print("Randomized %d seeds in %.1f seconds (%.1f seeds/sec)."
+          % (len(seeds), elapsed, len(seeds) / max(elapsed, 1e-6)))
+    if map_stats["attempts"]:
+        print("Made %d map generation attempts: %d rejected early, %d failed."
+              % (map_stats["attempts"], map_stats["early_exits"],
+                 map_stats["failures"]))
+
+
+def farm(rom, args, prg, seeds, map_stats):
+    """
+    Randomizes seeds in a pool of args.batch_workers processes. Only the IPS
+    patch for each seed is sent back to be written out here, along with the
+    generate_stats of its map, which are added to map_stats.
+
+    The base ROM was parsed by load_rom before the pool starts. Where the
+    workers can be forked, they find it in the cache of rom_base and share it
+    copy-on-write; otherwise each worker parses it once.
+    """
+    chunksize = max(1, len(seeds) // (args.batch_workers * 8))
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+    with context.Pool(args.batch_workers, initializer=init_seed_worker,
+                      initargs=(rom.base.rom_data, args)) as pool:
+        for seed, flags, ips_checksum, patch, stats in pool.imap(
+                randomize_seed, seeds, chunksize):
+            map_stats.update(stats)
+            print("Randomized %s using random seed %d..." % (args.filename, seed))
+            args.seed = seed
+            rom.rom_data[:] = rom.base.rom_data
+            rom.patch = ips.Patch(patch)
+            rom.patch.apply(rom.rom_data)
+            write_rom(rom, args, prg, flags, ips_checksum)
+
+
+worker_rom = None
+worker_args = None
+
+
+def init_seed_worker(base_data, args):
+    """
+    Sets up a seed farm worker process.
+    """
+    global worker_rom, worker_args
+    sys.stdout = open(os.devnull, 'w')
+    worker_args = argparse.Namespace(**vars(args))
+    # maps are generated in this process; one map worker gives the same map
+    # as any other number.
+    worker_args.map_workers = min(worker_args.map_workers, 1)
+    # a forked worker finds the parent's RomBase for base_data in the cache
+    worker_rom = Rom(args.filename, seed_scheme=args.seed_scheme, data=base_data)
+
+
+def randomize_seed(seed):
+    """
+    Randomizes a single seed in a seed farm worker process.
+
+    rtype: tuple
+    return: The seed, the flags, the IPS checksum, the encoded IPS patch and
+      the generate_stats of the map.
+    """
+    worker_args.seed = seed
+    random.seed(seed)
+    worker_rom.reset(seed)
+    flags, ips_checksum = randomize_rom(worker_rom, worker_args)
+    return (seed, flags, ips_checksum, worker_rom.patch.encode(),
+            worker_rom.owmap.generate_stats)
+
+
+def randomize_rom(rom, args):
+    """
+    Runs each randomization stage selected in args and commits the result.
+
+    :Parameters:
+      rom : Rom
+        A freshly loaded or reset Rom.
+      args : Namespace
+        The parsed command line arguments.
+
+    rtype: tuple
+    return: The flags for the options used and the IPS checksum.
+    """
+    flags = ""
 
     if not args.no_map:
         print("Generating new overworld map...")
         flags += "A"
-        while not rom.generate_map():
-            print("Error: " + str(rom.owmap.error) + ", retrying...")
+        if args.map_workers or args.seed_scheme >= 2:
+            rom.generate_map_parallel(args.seed, max(1, args.map_workers))
+        else:
+            while not rom.generate_map():
+                print("Error: " + str(rom.owmap.error) + ", retrying...")
 
     if args.speed_hacks:
         rom.speed_hacks()
@@ -1177,7 +1522,7 @@ def randomize(args):
         flags += 'D'
 
     rom.finalize()
-    ips_checksum = rom.sha1(rom.patch.encode())
+    ips_checksum = rom.patch.sha1()
 
     if args.disable_music:
         rom.disable_music()  # call this last so it doesn't affect the IPS checksum (since it doesn't affect gameplay)
@@ -1194,6 +1539,13 @@ def randomize(args):
     flags.sort()
     flags = ''.join(flags)
 
+    return flags, ips_checksum
+
+
+def write_rom(rom, args, prg, flags, ips_checksum):
+    """
+    Writes the randomized ROM, and the IPS or BPS patch if requested.
+    """
     print("IPS Checksum: %s" % ips_checksum)
     print("New ROM Checksum: %s" % rom.sha1())
     if args.output_dir and not args.output_dir.endswith(os_sep):
@@ -1201,10 +1553,17 @@ def randomize(args):
     output_filename = "%sDWRando.%s.%d.%snes" % (args.output_dir,
                                                  flags, args.seed, prg)
     rom.write(output_filename)
-    if args.ips:
-        output_filename = "%sDWRando.%s.%d.%sips" % (args.output_dir,
-                                                     flags, args.seed, prg)
-        rom.write(output_filename, rom.patch.encode())
+    if args.ips or args.format:
+        patch_format = args.format or "ips"
+        output_filename = "%sDWRando.%s.%d.%s%s" % (args.output_dir, flags,
+                                                    args.seed, prg, patch_format)
+        patch = rom.patch.compact(rom.base.rom_data).encode()
+        if patch_format == "bps":
+            ips_size = len(patch)
+            patch = ips.create_bps(rom.base.rom_data, rom.rom_data)
+            print("BPS patch: %d bytes, IPS patch: %d bytes." %
+                  (len(patch), ips_size))
+        rom.write(output_filename, patch)
 
 
 if __name__ == "__main__":
@@ -47,6 +47,45 @@ class SquareGrid:
         results = filter(self.passable, results)
         return results
 
+class ArrayGrid:
+    """
+    A square grid which uses integer node ids and flat arrays in place of
+    tuples, lists and dicts. The grid is surrounded by a border of walls, so
+    neighbors can be found by adding fixed offsets without any bounds checks.
+    """
+    def __init__(self, width, height, passable=None):
+        self.width = width
+        self.height = height
+        self.stride = width + 2
+        self.size = self.stride * (height + 2)
+        self.open = bytearray(self.size)
+        self.offsets = (1, -self.stride, -1, self.stride)
+        if passable is not None:
+            for y in range(height):
+                start = self.node(0, y)
+                self.open[start:start+width] = bytes(
+                    passable[y*width:(y+1)*width])
+    
+    def node(self, x, y):
+        return (y + 1) * self.stride + x + 1
+    
+    def location(self, id):
+        y, x = divmod(id, self.stride)
+        return x - 1, y - 1
+    
+    def in_bounds(self, id):
+        (x, y) = self.location(id)
+        return 0 <= x < self.width and 0 <= y < self.height
+    
+    def passable(self, id):
+        return self.open[id] != 0
+    
+    def neighbors(self, id):
+        return [id + offset for offset in self.offsets if self.open[id + offset]]
+    
+    def cost(self, *args):
+        return 1
+
 import heapq
 
 class PriorityQueue:
@@ -123,3 +162,32 @@ def a_star_search(graph, start, goal):
                 came_from[next] = current
     
     return came_from, cost_so_far
+
+from array import array
+
+def label_components(graph):
+    # Labels each group of connected passable nodes in an ArrayGrid. Returns
+    # an array of labels indexed by node id (0 for walls) and a list of the
+    # size of each group, indexed by label.
+    labels = array('i', [0]) * graph.size
+    sizes = [0]
+    open_, offsets = graph.open, graph.offsets
+    
+    for start in range(graph.size):
+        if not open_[start] or labels[start]:
+            continue
+        label = len(sizes)
+        labels[start] = label
+        stack = [start]
+        size = 0
+        while stack:
+            current = stack.pop()
+            size += 1
+            for offset in offsets:
+                next = current + offset
+                if open_[next] and not labels[next]:
+                    labels[next] = label
+                    stack.append(next)
+        sizes.append(size)
+    
+    return labels, sizes
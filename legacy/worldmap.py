@@ -4,8 +4,17 @@ import random
 import argparse
 import pathfinding
 import struct
+import collections
+import copy
+import hashlib
+import multiprocessing
 import ips
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 ########################################################
 # Tiles:
 #  0 - Grass
@@ -79,11 +88,18 @@ class WorldMap:
   tiles = ("grass", "desert", "hill", "mountain", "water", "block", 
            "trees", "swamp", "town", "cave",  "castle", "bridge", "stairs")
   border_addresses = {3:0x3d, 4:0x42, 7:0x51, 8:0x56, 9:0x5b, 10:0x60, 11:0x65}
+  # store generated maps in a uint8 ndarray when numpy is available
+  use_numpy = numpy is not None
+  # let rows share data when the map is too large to fit otherwise
+  compact_encoding = True
+  # reject terrain that can't pass before placing landmarks on it
+  early_exit = True
 
 
   def __init__(self, rom_data=None): 
     self.rom_data = rom_data
-    self.grid = None
+    self.rng = random # the random number generator used to build the map
+    self.grid = None # a list of rows, or a 2d ndarray if use_numpy is set
     self.warps_from = []
     self.warps_to   = []
     self.return_point = None
@@ -93,6 +109,9 @@ class WorldMap:
     self.green_dragon = None
     self.golem = None
     self.chests = None
+    self.encode_stats = None
+    self.generate_stats = {"attempts": 0, "early_exits": 0, "failures": 0}
+    self.vanilla = None # the map as read from rom_data, see read_vanilla
     self.revert()
     self.error = None
 
@@ -104,23 +123,25 @@ class WorldMap:
     return: The newly generated map
     """
     self.error = None
+    self.generate_stats["attempts"] += 1
+    self.map_grid = None
     self.grid = []
     for i in range(self.map_height):
       self.grid.append([WATER]*self.map_width)
     tiles = [GRASS, GRASS, GRASS, SWAMP, DESERT, DESERT, HILL, MOUNTAIN,
              TREES, TREES, TREES, WATER, WATER, WATER, WATER]
     for i in range(12):
-      random.shuffle(tiles)
+      self.rng.shuffle(tiles)
       for tile in tiles:
         points = []
         size = round((self.map_width * self.map_height) / 30)
-        size = random.randint(round(size/4), size)
+        size = self.rng.randint(round(size/4), size)
         if tile == MOUNTAIN:
           size >>= 1
-        points.append((random.randint(0,self.map_width-1), 
-                      random.randint(0,self.map_height-1)))
+        points.append((self.rng.randint(0,self.map_width-1), 
+                      self.rng.randint(0,self.map_height-1)))
         while size > 0:
-          directions = random.randint(0,15)
+          directions = self.rng.randint(0,15)
           new_points = []
           for point in points:
             self.grid[point[0]][point[1]] = tile
@@ -157,27 +178,157 @@ class WorldMap:
              and MOUNTAIN not in (row[j], row[j+3])):
           row[j+1],row[j+2] = row[j],row[j+3]
 
-    #remove errantly placed bridges 
-    for i in range(len(self.grid)-1):
-      for j in range(1, len(self.grid[i])):
-        if self.grid[i][j] == BRIDGE and self.grid[i+1][j] not in IMPASSABLE:
-          self.grid[i][j] = self.grid[i][j-1]
+    # The smoothing above reads tiles it has just changed, so it has to walk
+    # the rows in order; the remaining passes work on the whole array.
+    if self.use_numpy:
+      self.grid = numpy.array(self.grid, dtype=numpy.uint8)
+    self.remove_errant_bridges()
+
+    self.map_grid = MapGrid(self.grid)
+    error = self.predict_failure() if self.early_exit else None
+    if error:
+      self.error = SanityError(error)
+      self.generate_stats["early_exits"] += 1
+      return False
 
     try:
       self.place_landmarks()
     except SanityError as e:
       self.error = e
+      self.generate_stats["failures"] += 1
       return False
 
     self.encode()
     if len(self.encoded) > 2534:
       self.error = SanityError("Compressed map is too large (%d bytes)" 
               % len(self.encoded))
+      self.generate_stats["failures"] += 1
       return False
     self.generated = True
     self.update_warps()
     return True
 
+  def generate_seeded(self, seed):
+    """
+    Makes a single attempt at generating a map with its own random seed,
+    leaving the current random number generator untouched.
+
+    :Parameters:
+      seed : int
+        The seed for this attempt.
+
+    rtype: bool
+    return: Whether or not the map was generated successfully.
+    """
+    rng = self.rng
+    self.rng = random.Random(seed)
+    try:
+      return self.generate()
+    finally:
+      self.rng = rng
+
+  def generate_parallel(self, seed, workers=1):
+    """
+    Generates a map, seeding each attempt separately from the given seed.
+    Attempts are made in batches across a pool of processes, and the
+    lowest numbered attempt that succeeds is used, so the result is the same
+    regardless of the number of workers. Every attempt made, including the
+    rest of the last batch, is counted in generate_stats.
+
+    :Parameters:
+      seed : int
+        The seed to derive the seed for each attempt from.
+      workers : int
+        The number of processes to use. 1 runs every attempt in this process.
+
+    rtype: int
+    return: The number of the attempt that was used.
+    """
+    attempt = 0
+    if workers <= 1:
+      while not self.generate_seeded(attempt_seed(seed, attempt)):
+        print("Error: " + str(self.error) + ", retrying...")
+        self.revert()
+        attempt += 1
+      return attempt
+
+    with multiprocessing.Pool(workers, initializer=init_map_worker,
+                              initargs=(bytes(self.rom_data),)) as pool:
+      while True:
+        batch = [(seed, attempt + i) for i in range(workers)]
+        results = pool.map(generate_attempt, batch)
+        for n, state, error, stats in results:
+          for key, count in stats.items():
+            self.generate_stats[key] += count
+        for n, state, error, stats in results:
+          if state is not None:
+            self.restore(state)
+            return n
+          print("Error: " + error + ", retrying...")
+        attempt += workers
+
+  def generated_state(self):
+    """
+    Returns the parts of this map which are changed by generate, so they can
+    be passed between processes.
+
+    rtype: tuple
+    return: The generated map state.
+    """
+    return (self.grid, self.warps_from, self.return_point, self.rainbow_bridge,
+            self.encoded, self.encode_stats, self.patch)
+
+  def restore(self, state):
+    """
+    Replaces this map with one returned from generated_state.
+
+    :Parameters:
+      state : tuple
+        The generated map state.
+    """
+    (self.grid, self.warps_from, self.return_point, self.rainbow_bridge,
+     self.encoded, self.encode_stats, self.patch) = state
+    self.map_grid = None
+    self.error = None
+    self.generated = True
+
+  def predict_failure(self):
+    """
+    Checks whether the terrain can't possibly pass the checks made after the
+    landmarks are placed, so the map can be rejected before doing that work.
+
+    rtype: str
+    return: The reason the map is certain to fail, or None if it may pass.
+    """
+    # The encoded size isn't checked here: rows can share data in the
+    # compact encoding, so their run counts don't bound its size.
+    if max(self.map_grid.component_sizes) < self.min_walkable:
+      return "Accessible land area is too small"
+    return None
+
+  def remove_errant_bridges(self):
+    """
+    Replaces bridges that don't have an impassable tile below them with the
+    tile to their left.
+    """
+    if not is_array(self.grid):
+      for i in range(len(self.grid)-1):
+        for j in range(1, len(self.grid[i])):
+          if self.grid[i][j] == BRIDGE and self.grid[i+1][j] not in IMPASSABLE:
+            self.grid[i][j] = self.grid[i][j-1]
+      return
+
+    # The rows below haven't been modified yet when each row is processed, so
+    # the bridges can all be found at once. A run of errant bridges all
+    # take the value of the tile to the left of the run.
+    grid = self.grid
+    errant = numpy.zeros(grid.shape, dtype=bool)
+    errant[:-1, 1:] = ((grid[:-1, 1:] == BRIDGE) & 
+                       ~numpy.isin(grid[1:, 1:], IMPASSABLE))
+    columns = numpy.where(errant, 0, numpy.arange(grid.shape[1]))
+    numpy.maximum.accumulate(columns, axis=1, out=columns)
+    self.grid = numpy.take_along_axis(grid, columns, axis=1)
+
   def set_border_tile(self, index, x, y):
     """
     Converts a map tile into a border tile for towns
@@ -214,7 +365,9 @@ class WorldMap:
     tantegel = (x, y)
     self.add_warp(1, x, y, CASTLE)
 
-    grid = MapGrid(self.grid)
+    if self.map_grid is None:
+      self.map_grid = MapGrid(self.grid)
+    grid = self.map_grid
 
     if self.plot_size(grid, tantegel) < self.min_walkable:
       raise SanityError("Accessible land area is too small")
@@ -297,6 +450,8 @@ class WorldMap:
         The new tile type.
     """
     self.grid[y][x] = tile
+    if self.map_grid is not None:
+      self.map_grid.update(x, y)
 
   def place_charlock(self, x, y):
     """
@@ -343,12 +498,12 @@ class WorldMap:
     rtype: tuple
     return: An x and y coordinate on the map.
     """
-    came_from = {}
-    x = y = 0
-    while not (x, y) in came_from.keys():
-      x, y = random.randint(minx, maxx), random.randint(miny, maxy)
-      came_from, cost_so_far = pathfinding.a_star_search(grid, from_, (x, y))
-    return x, y
+    # each candidate is checked against the labels of the grid, but they
+    # are drawn the same way as always so that seeds give the same maps.
+    while True:
+      x, y = self.rng.randint(minx, maxx), self.rng.randint(miny, maxy)
+      if grid.connected(from_, (x, y)):
+        return x, y
     
   def is_accessible(self, grid, from_, to):
     """
@@ -362,26 +517,21 @@ class WorldMap:
     rtype: bool
     return: Whether or not the player is able to walk between the 2 coordinates.
     """
-    came_from, cost_so_far = pathfinding.a_star_search(grid, from_, to)
-    return to in came_from.keys()
+    return grid.connected(from_, to)
 
   def plot_size(self, grid, point):
     """
-    Determines if a particular tile is accessible from another
+    Determines the size of the land area accessible from a particular tile
     :Parameters:
       grid : MapGrid
         A MapGrid object created from the world map grid
-      from_ : tuple(int)
+      point : tuple(int)
         x and y coordinates of the starting point.
-      to : tuple(int)
-        x and y coordinates of the ending point.
 
-    rtype: bool
-    return: Whether or not the player is able to walk between the 2 coordinates.
+    rtype: int
+    return: The number of tiles the player is able to walk to from the point.
     """
-    came_from, cost_so_far = \
-      pathfinding.a_star_search(grid, point, (self.map_width, self.map_height))
-    return len(came_from.keys())
+    return grid.component_size(point)
 
   def random_land(self, minx=1, maxx=118, miny=1, maxy=118):
     """
@@ -400,9 +550,9 @@ class WorldMap:
     rtype: tuple
     return: An x and y coordinate on the map.
     """
-    x, y = random.randint(minx, maxx), random.randint(miny, maxy)
+    x, y = self.rng.randint(minx, maxx), self.rng.randint(miny, maxy)
     while self.grid[y][x] not in (GRASS, DESERT, HILL, TREES, SWAMP):
-      x, y = random.randint(minx, maxx), random.randint(miny, maxy)
+      x, y = self.rng.randint(minx, maxx), self.rng.randint(miny, maxy)
     return x, y
 
   def add_warp(self, m, x, y, type_):
@@ -459,6 +609,33 @@ class WorldMap:
     rtype: bytearray
     return: The RLE data for the ROM 
     """
+    if is_array(self.grid):
+      map_data, pointers = self.rle_encode_array()
+    else:
+      map_data, pointers = self.rle_encode()
+
+    rle_data, rle_pointers = map_data, pointers
+    map_data, pointers = self.optimize(rle_data, rle_pointers)
+    if self.compact_encoding and self.encode_stats["free"] < 0:
+      stats = self.encode_stats
+      map_data, pointers = self.compact(rle_data, rle_pointers)
+      if self.encode_stats["size"] >= stats["size"]:
+        map_data, pointers = self.optimize(rle_data, rle_pointers)
+    # create a byte array from the pointers, suitable for ROM insertion.
+    pointer_data = struct.pack("<%dH" % len(pointers), *pointers)
+
+    self.encoded = map_data + pointer_data
+    self.add_patch(0x1d6d, self.encoded)
+    return self.encoded
+
+  def rle_encode(self):
+    """
+    Run length encodes each row of the map. Each byte holds the tile type in
+    the upper nybble and the number of repeats in the lower nybble.
+
+    rtype: tuple
+    return: The RLE data and the pointer to the beginning of each row.
+    """
     map_data = []
     pointers = []
     for row in self.grid:
@@ -482,21 +659,40 @@ class WorldMap:
         map_data.append(tile << 4 | count)
         last_tile = None
         count = 0
+    return bytearray(map_data), pointers
 
-    map_data, pointers = self.optimize(bytearray(map_data), pointers)
-    # create a byte array from the pointers, suitable for ROM insertion.
-    pointer_data = bytearray()
-    for i in range(len(pointers)):
-      pointer_data.append(pointers[i] & 0xff)
-      pointer_data.append(pointers[i] >> 8)
+  def rle_encode_array(self):
+    """
+    Run length encodes the map in the same way as rle_encode, using numpy 
+    to find all of the runs at once.
 
-    self.encoded = map_data + pointer_data
-    self.add_patch(0x1d6d, self.encoded)
-    return self.encoded
+    rtype: tuple
+    return: The RLE data and the pointer to the beginning of each row.
+    """
+    grid = numpy.asarray(self.grid, dtype=numpy.uint8)
+    height, width = grid.shape
+    # a run begins at the start of every row and wherever the tile changes.
+    run_starts = numpy.ones(grid.shape, dtype=bool)
+    run_starts[:, 1:] = grid[:, 1:] != grid[:, :-1]
+    run_starts = numpy.flatnonzero(run_starts)
+    run_lengths = numpy.diff(numpy.append(run_starts, grid.size))
+    # runs longer than 16 tiles are split into multiple bytes.
+    run_bytes = (run_lengths + 15) >> 4
+    first_byte = numpy.cumsum(run_bytes) - run_bytes
+    runs = numpy.repeat(numpy.arange(len(run_starts)), run_bytes)
+    remaining = (run_lengths[runs] - 
+                 ((numpy.arange(len(runs)) - first_byte[runs]) << 4))
+    counts = numpy.minimum(remaining, 16) - 1
+    tiles = grid.ravel()[run_starts][runs].astype(numpy.intp)
+    map_data = bytearray(((tiles << 4) | counts).astype(numpy.uint8).tobytes())
+    row_runs = numpy.searchsorted(run_starts, numpy.arange(height) * width)
+    pointers = (first_byte[row_runs] + 0x9d5d).tolist()
+    return map_data, pointers
 
   def optimize(self, encoded_map, pointers):
     """
-    Optimizes the map by removing unneeded bytes. Not yet implemented.
+    Optimizes the map by removing unneeded bytes. Statistics about the 
+    optimization are stored in encode_stats.
 
     :Parameters:
       encoded_map : bytearray
@@ -505,25 +701,118 @@ class WorldMap:
       pointers : array(int)
         The pointer addresses to the beginning of each tile row.
 
-    rtype: bytearray
-    return: The map optimized for use in the ROM.
-    """
-    # remove redundant bytes at the end of each row.
-    print("Optimizing compressed map... ", end="")
-    saved = 0
-    for i in range(1, len(pointers)):
-      offset = pointers[i] - 0x9d5d
-      if (((encoded_map[offset-1] & 0xf0) == (encoded_map[offset] & 0xf0)) and 
-         ((encoded_map[offset-1] & 0xf) <= (encoded_map[offset] & 0xf))):
-        saved += 1
-        encoded_map = encoded_map[:offset-1] + encoded_map[offset:]
-        for j in range(i, len(pointers)):
-          pointers[j] -= 1
-    print("(Saved %d bytes)" % saved)
+    rtype: tuple
+    return: The map optimized for use in the ROM and the new row pointers.
+    """
+    # Remove redundant bytes at the end of each row. A row doesn't need its 
+    # last byte if the next row starts with at least as many of the same tile,
+    # since decoding stops once the row is full.
+    optimized = bytearray()
+    new_pointers = []
+    ends = pointers[1:] + [len(encoded_map) + 0x9d5d]
+    for start, end in zip(pointers, ends):
+      start -= 0x9d5d
+      end -= 0x9d5d
+      if (optimized and (optimized[-1] & 0xf0) == (encoded_map[start] & 0xf0) 
+          and (optimized[-1] & 0xf) <= (encoded_map[start] & 0xf)):
+        del optimized[-1]
+      new_pointers.append(len(optimized) + 0x9d5d)
+      optimized += encoded_map[start:end]
+
+    self.encode_stats = {
+      "encoder": "rle",
+      "rle_size": len(encoded_map),
+      "row_tails_saved": len(encoded_map) - len(optimized),
+      "size": len(optimized),
+      "free": self.encoded_size - len(optimized)
+    }
 
     #extend the map data to the right length.
-    encoded_map += bytearray([0xff] * (self.encoded_size - len(encoded_map)))
-    return encoded_map, pointers
+    optimized += bytearray([0xff] * (self.encoded_size - len(optimized)))
+    return optimized, new_pointers
+
+  def compact(self, encoded_map, pointers):
+    """
+    An alternative to optimize which lets rows share data. Identical rows
+    use the same bytes, rows which can be found within another row point into
+    it, and rows which begin the same way another row ends overlap it.
+    Statistics about the result are stored in encode_stats.
+
+    :Parameters:
+      encoded_map : bytearray
+        The map encoded for use in the ROM, one row after another.
+      pointers : array(int)
+        The pointer addresses to the beginning of each tile row.
+
+    rtype: tuple
+    return: The compacted map for use in the ROM and the new row pointers.
+    """
+    ends = pointers[1:] + [len(encoded_map) + 0x9d5d]
+    rows = [bytes(encoded_map[start-0x9d5d:end-0x9d5d])
+            for start, end in zip(pointers, ends)]
+
+    # Keep only the rows that aren't contained in another one. Anything that
+    # could contain a row is sorted before it.
+    unique = sorted(set(rows), key=lambda r: (len(r), r[-1] & 0xf, r), 
+                    reverse=True)
+    roots = []
+    hosts = {}
+    for row in unique:
+      for root in roots:
+        offset = find_row(root, row)
+        if offset is not None:
+          hosts[row] = (root, offset)
+          break
+      else:
+        roots.append(row)
+
+    # Chain the remaining rows together, greedily taking the largest overlap 
+    # between the end of one chain and the start of another first. 
+    successors = {}
+    chain_heads = {root: root for root in roots} # indexed by chain tail
+    chain_tails = {root: root for root in roots} # indexed by chain head
+    for size in range(max(len(root) for root in roots) - 1, 0, -1):
+      starts = {}
+      for root in roots:
+        if root in chain_tails and len(root) >= size:
+          starts.setdefault((root[:size-1], root[size-1] & 0xf0), []).append(
+              root)
+      for root in roots:
+        if root not in chain_heads or len(root) <= size:
+          continue
+        for other in starts.get((root[-size:-1], root[-1] & 0xf0), ()):
+          if (other in chain_tails and other != chain_heads[root] and 
+              (other[size-1] & 0xf) >= (root[-1] & 0xf)):
+            successors[root] = (other, size)
+            head, tail = chain_heads.pop(root), chain_tails.pop(other)
+            chain_heads[tail], chain_tails[head] = head, tail
+            break
+
+    compacted = bytearray()
+    positions = {}
+    for root in roots:
+      if root not in chain_tails:
+        continue
+      positions[root] = len(compacted)
+      compacted += root
+      while root in successors:
+        root, size = successors[root]
+        positions[root] = len(compacted) - size
+        compacted[len(compacted)-size:] = root
+    for row, (root, offset) in hosts.items():
+      positions[row] = positions[root] + offset
+    new_pointers = [positions[row] + 0x9d5d for row in rows]
+
+    self.encode_stats = {
+      "encoder": "compact",
+      "rle_size": len(encoded_map),
+      "rows_shared": len(rows) - len(roots),
+      "size": len(compacted),
+      "free": self.encoded_size - len(compacted)
+    }
+
+    compacted += bytearray([0xff] * (self.encoded_size - len(compacted)))
+    return compacted, new_pointers
 
   def decode(self, map_data):
     """
@@ -540,12 +829,12 @@ class WorldMap:
     """
     pointer_data = map_data[-240:]
     map_data = map_data[:-240]
-    pointers = []
-    for i in range(0, 240, 2):
-      # pointer data -> value - 0x8000 + 16
-      pointer = pointer_data[i+1] << 8 | pointer_data[i]
-      pointer -= 0x9d5d
-      pointers.append(pointer)
+    # pointer data -> value - 0x8000 + 16
+    pointers = [pointer - 0x9d5d for pointer in 
+                struct.unpack("<%dH" % (len(pointer_data) // 2), pointer_data)]
+
+    if self.use_numpy and self.rle_decode_array(map_data, pointers):
+      return self.grid
 
     colcount = 0
     rowcount = 0
@@ -566,31 +855,90 @@ class WorldMap:
       self.grid.append(decoded_row)
     return self.grid
 
+  def rle_decode_array(self, map_data, pointers):
+    """
+    Decodes all rows of the map at once using numpy.
+
+    :Parameters:
+      map_data : bytearray
+        The RLE data from the ROM, without the pointer table.
+      pointers : list(int)
+        The offset of the beginning of each row in the RLE data.
+
+    rtype: bool
+    return: False if some row can't be fully decoded from the data, in which 
+      case the grid is left untouched.
+    """
+    if not len(map_data) or min(pointers) < 0 or max(pointers) >= len(map_data):
+      return False
+    data = numpy.frombuffer(bytes(map_data), dtype=numpy.uint8)
+    # the number of tiles decoded by the end of each byte
+    ends = numpy.cumsum((data & 0xf).astype(numpy.intp) + 1)
+    starts = ends[pointers] - ((data[pointers] & 0xf).astype(numpy.intp) + 1)
+    # find the byte that holds each tile on the map
+    indices = numpy.searchsorted(ends, 
+        starts[:, None] + numpy.arange(self.map_width), side="right")
+    if indices[:, -1].max() >= len(data):
+      return False
+    self.grid = data[indices] >> 4
+    return True
+
+
+  def copy(self):
+    """
+    Returns a copy of this map that can be changed without affecting this one.
+    The grid is shared, since generate replaces it rather than changing it.
+
+    rtype: WorldMap
+    return: The new map.
+    """
+    other = copy.copy(self)
+    other.warps_from = list(self.warps_from)
+    other.warps_to = list(self.warps_to)
+    other.return_point = list(self.return_point)
+    other.generate_stats = dict(self.generate_stats)
+    other.patch = self.patch.copy()
+    return other
 
   def revert(self):
     """
-    Creates a map from existing rom data.
+    Restores the map read from the rom data, undoing any generated map. The
+    rom data is only parsed the first time; after that the saved parts are
+    put back, and only the lists that get changed in place are copied.
+    """
+    if self.vanilla is None:
+      self.vanilla = self.read_vanilla()
+    (self.encoded, self.grid, warps_from, self.warps_to, return_point,
+     self.axe_knight, self.green_dragon, self.golem,
+     self.rainbow_bridge) = self.vanilla
+    self.warps_from = list(warps_from)
+    self.return_point = list(return_point)
+    self.map_grid = None
+    self.patch = ips.Patch(label="map")
+
+  def read_vanilla(self):
+    """
+    Reads the map, warps, return point and fixed encounters from the rom data.
+    None of the result may be changed in place, since revert shares it.
 
-    :Parameters:
-      rom_data : bytearray
-        The ROM data to be parsed
+    rtype: tuple
+    return: The map state to be restored by revert.
     """
-    self.encoded = self.rom_data[0x1d6d:0x2753]
-    self.decode(self.encoded)
+    encoded = self.rom_data[0x1d6d:0x2753]
+    self.decode(encoded)
     self.read_warps()
 
     # read the current return point
-    self.return_point = []
+    return_point = []
     for i in range(3):
-      self.return_point.append(self.rom_data[self.return_point_addr[i]])
+      return_point.append(self.rom_data[self.return_point_addr[i]])
 
     # read the fixed encounter data
-    self.axe_knight = self.rom_data[self.axe_knight_slice]
-    self.green_dragon = self.rom_data[self.green_dragon_slice]
-    self.golem = self.rom_data[self.golem_slice]
-
-    self.rainbow_bridge = self.rom_data[self.rainbow_bridge_slice]
-    self.patch = ips.Patch()
+    return (encoded, self.grid, tuple(self.warps_from), tuple(self.warps_to),
+            tuple(return_point), self.rom_data[self.axe_knight_slice],
+            self.rom_data[self.green_dragon_slice],
+            self.rom_data[self.golem_slice],
+            self.rom_data[self.rainbow_bridge_slice])
 
   def read_warps(self):
     """
@@ -613,12 +961,12 @@ class WorldMap:
     cave_end = 8 if self.generated else 7 
     caves = [self.warps_from[x] for x in self.cave_warps[:cave_end]]
     towns = [self.warps_from[x] for x in self.town_warps]
-    random.shuffle(caves)
-    random.shuffle(towns)
+    self.rng.shuffle(caves)
+    self.rng.shuffle(towns)
     while not self.generated and (tuple(caves[1]) == (1, 108, 109) or
            (tuple(towns[4]) == (1, 102, 72) and caves[1][0] in (4, 9)) or
            (tuple(towns[0]) == (1, 102, 72) and caves[1][0] == 9)):
-      random.shuffle(caves)
+      self.rng.shuffle(caves)
     # save the shuffling
     for i in range(cave_end):
       self.warps_from[self.cave_warps[i]] = caves[i]
@@ -733,6 +1081,7 @@ class MapGrid(pathfinding.SquareGrid):
   def __init__(self, grid):
     super(MapGrid, self).__init__(len(grid[0]), len(grid))
     self.grid = grid
+    self.label_components()
 
   def passable(self, id):
     """
@@ -747,6 +1096,267 @@ class MapGrid(pathfinding.SquareGrid):
     """
     return 1
 
+  def label_components(self):
+    """
+    Labels each passable tile with the id of the connected area of land it
+    belongs to, and records the size of each area. Impassable tiles are
+    labeled 0. Changes made to the map afterward must be passed to update.
+    """
+    if is_array(self.grid):
+      passable = (~numpy.isin(self.grid, IMPASSABLE)).ravel().tolist()
+    else:
+      passable = [tile not in IMPASSABLE for row in self.grid for tile in row]
+    self.graph = pathfinding.ArrayGrid(self.width, self.height, passable)
+    self.components, self.component_sizes = \
+        pathfinding.label_components(self.graph)
+
+  def update(self, x, y):
+    """
+    Updates the labels after a tile on the map has been changed. Only the
+    areas next to the tile are searched, so this is much faster than labeling
+    the whole map again.
+
+    :Parameters:
+      x : int
+        The x coordinate of the changed tile.
+      y : int
+        The y coordinate of the changed tile.
+    """
+    node = self.graph.node(x, y)
+    passable = self.grid[y][x] not in IMPASSABLE
+    if passable == self.graph.passable(node):
+      return
+    self.graph.open[node] = passable
+    labels = self.components
+    neighbors = [node + offset for offset in self.graph.offsets
+                 if labels[node + offset]]
+    if passable:
+      self.join_components(node, neighbors)
+    else:
+      self.split_component(node, neighbors)
+
+  def join_components(self, node, neighbors):
+    """
+    Adds a newly passable tile to the component of its neighbors, merging
+    the smaller components into the largest one if it connects several.
+    """
+    labels, sizes = self.components, self.component_sizes
+    joined = sorted(set(labels[n] for n in neighbors), 
+                    key=lambda label: sizes[label], reverse=True)
+    if not joined:
+      labels[node] = len(sizes)
+      sizes.append(1)
+      return
+    label = joined[0]
+    labels[node] = label
+    sizes[label] += 1
+    for other in joined[1:]:
+      stack = [n for n in neighbors if labels[n] == other]
+      for n in stack:
+        labels[n] = label
+      while stack:
+        current = stack.pop()
+        for offset in self.graph.offsets:
+          next = current + offset
+          if labels[next] == other:
+            labels[next] = label
+            stack.append(next)
+      sizes[label] += sizes[other]
+      sizes[other] = 0
+
+  def split_component(self, node, neighbors):
+    """
+    Removes a newly impassable tile from its component, giving new labels to
+    any pieces which were cut off from the rest. A search is run outward from
+    each neighbor in turn, and searches which meet are combined, so the work
+    done is proportional to the size of the smaller pieces.
+    """
+    labels, sizes = self.components, self.component_sizes
+    label = labels[node]
+    labels[node] = 0
+    sizes[label] -= 1
+    if len(neighbors) < 2:
+      return
+    owner = {}
+    groups = {}
+    for n in neighbors:
+      if n in owner:
+        continue
+      owner[n] = n
+      groups[n] = ([n], collections.deque([n]))
+    while len(groups) > 1:
+      for id in list(groups):
+        if id not in groups:
+          continue
+        nodes, frontier = groups[id]
+        if not frontier: # this piece has been cut off from the rest
+          new_label = len(sizes)
+          for n in nodes:
+            labels[n] = new_label
+          sizes.append(len(nodes))
+          sizes[label] -= len(nodes)
+          del groups[id]
+          if len(groups) == 1:
+            break
+          continue
+        current = frontier.popleft()
+        for offset in self.graph.offsets:
+          next = current + offset
+          if labels[next] != label:
+            continue
+          other = owner.get(next)
+          if other is None:
+            owner[next] = id
+            nodes.append(next)
+            frontier.append(next)
+          elif other != id: # these searches met, so combine them.
+            other_nodes, other_frontier = groups.pop(other)
+            for n in other_nodes:
+              owner[n] = id
+            nodes.extend(other_nodes)
+            frontier.extend(other_frontier)
+            if len(groups) == 1:
+              break
+
+  def component(self, id):
+    """
+    Returns the id of the connected area the given tile belongs to.
+
+    :Parameters:
+      id : tuple(int)
+        x and y coordinates of the tile.
+
+    rtype: int
+    return: The component id, or 0 if the tile is impassable or off the map.
+    """
+    if not self.in_bounds(id):
+      return 0
+    return self.components[self.graph.node(*id)]
+
+  def connected(self, from_, to):
+    """
+    Determines whether the player can walk between two tiles.
+
+    :Parameters:
+      from_ : tuple(int)
+        x and y coordinates of the starting point.
+      to : tuple(int)
+        x and y coordinates of the ending point.
+
+    rtype: bool
+    return: Whether or not the 2 tiles are connected.
+    """
+    if tuple(from_) == tuple(to):
+      return True
+    component = self.component(from_)
+    return component != 0 and component == self.component(to)
+
+  def component_size(self, id):
+    """
+    Returns the number of tiles reachable from the given tile, including itself.
+
+    :Parameters:
+      id : tuple(int)
+        x and y coordinates of the tile.
+
+    rtype: int
+    return: The size of the connected area.
+    """
+    component = self.component(id)
+    return self.component_sizes[component] if component else 1
+
+def derive_seed(seed, *labels):
+  """
+  Derives a new random seed from a seed and some labels, such as the name of
+  a randomization stage or the number of an attempt.
+
+  :Parameters:
+    seed : int
+      The main random seed.
+    labels : str or int
+      The labels to derive the new seed from.
+
+  rtype: int
+  return: The derived seed.
+  """
+  key = ":".join(str(part) for part in (seed,) + labels)
+  return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "little")
+
+def attempt_seed(seed, attempt):
+  """
+  Derives the random seed for one map generation attempt from a main seed.
+
+  :Parameters:
+    seed : int
+      The main random seed.
+    attempt : int
+      The number of the attempt.
+
+  rtype: int
+  return: The seed for the attempt.
+  """
+  return derive_seed(seed, "map", attempt)
+
+worker_map = None
+
+def init_map_worker(rom_data):
+  """
+  Sets up a map generation worker process.
+  """
+  global worker_map
+  worker_map = WorldMap(bytearray(rom_data))
+
+def generate_attempt(seed_attempt):
+  """
+  Makes a map generation attempt in a worker process.
+
+  :Parameters:
+    seed_attempt : tuple
+      The main seed and the number of the attempt.
+
+  rtype: tuple
+  return: The attempt number, the generated state (None if the attempt
+    failed), the error message and the generate_stats of the attempt.
+  """
+  seed, attempt = seed_attempt
+  state = None
+  worker_map.generate_stats = dict.fromkeys(worker_map.generate_stats, 0)
+  if worker_map.generate_seeded(attempt_seed(seed, attempt)):
+    state = worker_map.generated_state()
+  error = str(worker_map.error)
+  worker_map.revert()
+  return attempt, state, error, worker_map.generate_stats
+
+def find_row(data, row):
+  """
+  Finds a place in some RLE data that a row can be decoded from. The last
+  byte of the row only needs to match the tile, since decoding stops once
+  the row is full.
+
+  :Parameters:
+    data : bytes
+      The RLE data to search.
+    row : bytes
+      The RLE data for a single row.
+
+  rtype: int
+  return: The offset of the row within the data, or None if it wasn't found.
+  """
+  head, last = row[:-1], row[-1]
+  offset = data.find(head)
+  while 0 <= offset <= len(data) - len(row):
+    byte = data[offset + len(head)]
+    if byte & 0xf0 == last & 0xf0 and byte & 0xf >= last & 0xf:
+      return offset
+    offset = data.find(head, offset + 1)
+  return None
+
+def is_array(grid):
+  """
+  Whether or not the given map grid is stored in a numpy ndarray.
+  """
+  return numpy is not None and isinstance(grid, numpy.ndarray)
+
 class SanityError(Exception):
   """
   An error to be thrown when the new map fails a sanity check.
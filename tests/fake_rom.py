@@ -0,0 +1,67 @@
+"""
+Builds a stand-in for the Dragon Warrior ROM, so the randomizer can be run by
+the tests without the real one. Only the tables the randomizer reads are
+filled in, and the world map is generated from a fixed seed.
+"""
+
+import io
+import os
+import sys
+import random
+import contextlib
+
+LEGACY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "legacy")
+if LEGACY not in sys.path:
+  sys.path.insert(0, LEGACY)
+
+import worldmap
+
+ROM_SIZE = 81936
+
+def fake_rom():
+  """
+  Returns the content of the fake ROM.
+
+  rtype: bytes
+  """
+  rom = bytearray(ROM_SIZE)
+  # warps
+  start = 0xf3d8
+  for i in range(51):
+    rom[start+3*i:start+3*i+3] = bytes((1, (i*7) % 120, (i*13) % 120))
+  for i in (19, 7):
+    rom[start+3*i] = 21
+  warp_maps = {0: 7, 2: 8, 3: 9, 9: 10, 10: 11, 11: 3, 4: 4, 6: 2}
+  for i in range(51):
+    rom[start+153+3*i:start+153+3*i+3] = bytes((warp_maps.get(i, 21), 0, 0))
+  # return points
+  rom[0xdb11] = 1
+  rom[0xdb15] = 43
+  rom[0xdb1d] = 43
+  # chests
+  chests = [1, 2, 3, 4, 5, 6, 0x10, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17,
+            18, 19, 20, 21, 0x17, 3, 2, 1, 4, 5, 6, 7, 8]
+  for i, chest in enumerate(chests):
+    rom[0x5ddd+4*i:0x5ddd+4*i+4] = bytes((i % 30, 1, 1, chest))
+  # zones, enemy stats, shops and the rest of the tables
+  for i in range(0xeaf9, 0xeb1f, 4):
+    rom[i] = 3 + (i % 7)
+  for i in range(0x60dd, 0x6191):
+    rom[i] = 10 + i % 50
+  for i in range(0xf36b, 0xf3a7):
+    rom[i] = i % 256
+  for i in range(0x19a1, 0x19cc):
+    rom[i] = [2, 3, 4, 0xfd][i % 4]
+  for i in range(0x5e5b, 0x60db):
+    rom[i] = (i * 7) % 200 + 1
+
+  # the overworld map
+  with contextlib.redirect_stdout(io.StringIO()):
+    owmap = worldmap.WorldMap(rom)
+    owmap.rng = random.Random(1)
+    owmap.compact_encoding = owmap.early_exit = False
+    while not owmap.generate():
+      owmap.revert()
+  rom[0x1d6d:0x2753] = owmap.encoded
+  return bytes(rom)
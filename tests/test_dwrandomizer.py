@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Tests for the randomizer in legacy/dwrandomizer.py, run on a fake ROM.
+Run with: python3 -m unittest discover tests
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+import multiprocessing
+from unittest import mock
+
+from fake_rom import fake_rom # also puts legacy on the path
+
+import dwrandomizer
+
+
+class RandomizerTests(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.directory = tempfile.mkdtemp()
+    cls.rom_name = os.path.join(cls.directory, "fake.nes")
+    with open(cls.rom_name, 'wb') as rom_file:
+      rom_file.write(fake_rom())
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.directory)
+
+  def run_randomizer(self, *options):
+    """
+    Runs the randomizer on the fake ROM.
+
+    rtype: tuple
+    return: The output printed, and a dict of the content of each file
+      written, by file name.
+    """
+    output_dir = tempfile.mkdtemp(dir=self.directory)
+    argv = ["dwrandomizer", "-o", output_dir] + list(options) + [self.rom_name]
+    printed = io.StringIO()
+    with mock.patch.object(sys, 'argv', argv), \
+         contextlib.redirect_stdout(printed):
+      dwrandomizer.main()
+    files = {}
+    for name in os.listdir(output_dir):
+      with open(os.path.join(output_dir, name), 'rb') as output_file:
+        files[name] = output_file.read()
+    return printed.getvalue(), files
+
+  def checksums(self, printed):
+    return [line for line in printed.splitlines() if "Checksum:" in line]
+
+  def test_seed_scheme_1_reproduces_earlier_versions(self):
+    # checksums of the same seeds randomized by the version before the seed
+    # schemes were added
+    expected = {
+      ("-s", "12345"): "0d3e728e39e322b794ef4aa150a05aad8b3ea889",
+      ("-s", "777", "-u", "-H", "-R", "-D", "-e"):
+        "69fa71cca5f2f5105074703aa8a6e3c451007c03",
+      ("-s", "31337", "--no-map"): "8aee982932103f356c1762f71b6507725a285c01",
+    }
+    for options, checksum in expected.items():
+      printed, files = self.run_randomizer(*options)
+      self.assertIn("IPS Checksum: " + checksum, self.checksums(printed))
+
+  def test_batch_matches_single_seeds(self):
+    options = ("-u", "-D", "--ips")
+    expected = {}
+    for seed in ("5", "6", "7"):
+      printed, files = self.run_randomizer("-s", seed, *options)
+      expected.update(files)
+    self.assertEqual(len(expected), 6)
+    for workers in ("1", "2"):
+      printed, files = self.run_randomizer("-b", "5-7", "--batch-workers",
+                                           workers, *options)
+      self.assertEqual(files, expected)
+
+  def test_batch_counts_map_attempts(self):
+    summaries = []
+    for workers in ("1", "2"):
+      printed, files = self.run_randomizer("-b", "1-8", "--seed-scheme", "2",
+                                           "--batch-workers", workers)
+      summaries.append([line for line in printed.splitlines()
+                        if "map generation attempts" in line])
+    # the attempts made in worker processes are counted too
+    self.assertEqual(summaries[0], ["Made 12 map generation attempts: "
+                                    "2 rejected early, 2 failed."])
+    self.assertEqual(summaries[1], summaries[0])
+
+  def test_batch_workers_share_the_parsed_rom(self):
+    if "fork" not in multiprocessing.get_all_start_methods():
+      self.skipTest("workers can't be forked here")
+    parsed_in = os.path.join(self.directory, "parsed_in")
+    parse = dwrandomizer.RomBase.__init__
+    def logged_parse(base, rom_data):
+      with open(parsed_in, 'a') as log_file:
+        log_file.write("%d\n" % os.getpid())
+      parse(base, rom_data)
+    dwrandomizer.rom_base.cache_clear()
+    with mock.patch.object(dwrandomizer.RomBase, '__init__', logged_parse):
+      self.run_randomizer("-b", "1-4", "--batch-workers", "2")
+    with open(parsed_in) as log_file:
+      self.assertEqual(log_file.read(), "%d\n" % os.getpid())
+
+  def test_map_workers_give_the_same_rom(self):
+    printed, expected = self.run_randomizer("-s", "6", "--map-workers", "1")
+    printed, files = self.run_randomizer("-s", "6", "--map-workers", "3")
+    self.assertEqual(files, expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
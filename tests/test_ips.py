@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Tests for the patch code in tools/ips.py and its copy in legacy/ips.py.
+Run with: python3 -m unittest discover tests
+"""
+
+import io
+import os
+import sys
+import random
+import tempfile
+import unittest
+import contextlib
+import importlib.util
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_ips(directory):
+  """
+  Loads the ips module from the given directory of the repository.
+  """
+  spec = importlib.util.spec_from_file_location("ips_" + directory,
+      os.path.join(ROOT, directory, "ips.py"))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def random_change(rng, content, edits=8, grow=0):
+  """
+  Returns a copy of content with random bytes, runs and copies of other
+  parts of it written over it, extended by grow random bytes.
+  """
+  changed = bytearray(content)
+  for _ in range(rng.randint(0, edits)):
+    i, n = rng.randrange(len(changed)), rng.randint(1, 40)
+    kind = rng.randrange(3)
+    if kind == 0:
+      changed[i:i+n] = rng.randbytes(len(changed[i:i+n]))
+    elif kind == 1:
+      changed[i:i+n] = bytes([rng.randrange(256)]) * len(changed[i:i+n])
+    else:
+      j = rng.randrange(len(content))
+      part = content[j:j+n][:len(changed[i:i+n])]
+      changed[i:i+len(part)] = part
+  return bytes(changed + rng.randbytes(grow))
+
+def cheapest_cover(content, required, allowed):
+  """
+  Finds the smallest encoded size of ips records covering every required
+  offset of content, by trying every record at every offset. Records may
+  only cover the allowed offsets.
+  """
+  best = {len(content): 0}
+  for start in range(len(content) - 1, -1, -1):
+    cost = None if start in required else best[start + 1]
+    end = start
+    while end < len(content) and end in allowed:
+      end += 1
+      options = [5 + end - start + best[end]]
+      if len(set(content[start:end])) == 1:
+        options.append(8 + best[end])
+      cost = min(options + ([cost] if cost is not None else []))
+    best[start] = cost if cost is not None else float('inf')
+  return best[0]
+
+
+class IpsTests:
+  ips = None
+
+  def test_create_apply_round_trip(self):
+    rng = random.Random(1)
+    for optimal in (False, True):
+      for _ in range(50):
+        orig = rng.randbytes(rng.randint(1, 3000))
+        patched = random_change(rng, orig, grow=rng.choice((0, 0, 20)))
+        patch = self.ips.Patch.create(orig, patched, optimal)
+        self.assertEqual(patch.apply(orig), patched)
+        encoded = patch.encode()
+        self.assertEqual(self.ips.Patch(encoded).apply(orig), patched)
+        self.assertEqual(self.ips.apply_ips(orig, encoded), patched)
+
+  def test_optimal_create_is_never_larger(self):
+    rng = random.Random(2)
+    for _ in range(50):
+      orig = bytes(rng.randrange(3) for _ in range(500))
+      patched = random_change(rng, orig, edits=20)
+      greedy = self.ips.Patch.create(orig, patched)
+      optimal = self.ips.Patch.create(orig, patched, True)
+      self.assertEqual(optimal.saved,
+                       len(greedy.encode()) - len(optimal.encode()))
+      self.assertGreaterEqual(optimal.saved, 0)
+
+  def test_create_splits_long_records(self):
+    rng = random.Random(8)
+    orig = bytes(10)
+    patched = orig + rng.randbytes(0x1fff0)
+    for optimal in (False, True):
+      patch = self.ips.Patch.create(orig, patched, optimal)
+      sizes = [record.rle_size or len(record.content)
+               for record in patch.records]
+      self.assertLessEqual(max(sizes), 0xffff)
+      self.assertEqual(self.ips.apply_ips(orig, patch.encode()), patched)
+      self.assertEqual(self.ips.Patch.create(b'', patched, optimal)
+                       .apply(b''), patched)
+
+  def test_diff_offsets(self):
+    rng = random.Random(3)
+    for _ in range(100):
+      orig = bytes(rng.randrange(2) for _ in range(rng.randint(0, 300)))
+      patched = random_change(rng, orig, grow=5) if orig else b'abc'
+      expected = [i for i in range(len(patched))
+                  if i >= len(orig) or orig[i] != patched[i]]
+      self.assertEqual(list(self.ips.diff_offsets(orig, patched, (16, 4))),
+                       expected)
+
+  def test_compact_is_optimal(self):
+    rng = random.Random(4)
+    for _ in range(300):
+      orig = bytes(rng.randrange(3) for _ in range(24))
+      patch = self.ips.Patch()
+      for _ in range(rng.randint(1, 4)):
+        address = rng.randrange(20)
+        if rng.random() < 0.3:
+          patch.append_content(address, bytes([rng.randrange(3)]),
+                               rng.randint(1, 4))
+        else:
+          patch.append_content(address, bytes(rng.randrange(3) for _ in
+                                               range(rng.randint(1, 4))))
+      patched = bytes(patch.apply(orig))
+      written = set()
+      for record in patch.records:
+        size = record.rle_size or len(record.content)
+        written.update(range(record.address, record.address + size))
+
+      compact = patch.compact()
+      self.assertEqual(compact.apply(orig), patched)
+      self.assertEqual(len(compact.encode()) - 8,
+                       cheapest_cover(patched, written, written))
+
+      # knowing the original, unchanged bytes may be covered too
+      compact = patch.compact(orig)
+      self.assertEqual(compact.apply(orig), patched)
+      self.assertEqual(len(compact.encode()) - 8,
+                       cheapest_cover(patched, written, range(len(patched))))
+
+  def test_merge_resolves_overlaps(self):
+    rng = random.Random(5)
+    for _ in range(200):
+      patch = self.ips.Patch()
+      for _ in range(rng.randint(1, 10)):
+        patch.label = rng.choice(("a", "b"))
+        address = rng.randrange(40)
+        if rng.random() < 0.3:
+          patch.append_content(address, bytes([rng.randrange(2)]),
+                               rng.randint(1, 8))
+        else:
+          patch.append_content(address, bytes(rng.randrange(2) for _ in
+                                               range(rng.randint(1, 8))))
+      orig = rng.randbytes(50)
+      merged = patch.merge()
+      self.assertEqual(merged.apply(orig), patch.apply(orig))
+      covered = set()
+      for record in merged.records:
+        size = record.rle_size or len(record.content)
+        span = set(range(record.address, record.address + size))
+        self.assertFalse(covered & span)
+        covered |= span
+
+  def test_merge_conflicts(self):
+    patch = self.ips.Patch(label="fixes")
+    patch.add_record(10, b'\x01\x02\x03\x04')
+    patch.label = "speed_hacks"
+    patch.add_record(12, b'\x03\x09\x09')
+    patch.label = "map"
+    patch.add_record(0, 0, 4)
+    patch.add_record(2, 0, 4)
+
+    conflicts = []
+    merged = patch.merge(conflicts)
+    # byte 12 is rewritten with the same value, so it isn't a conflict
+    self.assertEqual(conflicts, [(13, 14, "speed_hacks", "fixes")])
+    self.assertEqual([(r.address, bytes(r.content), r.rle_size)
+                      for r in merged.records],
+                     [(0, b'\x00', 2), (2, b'\x00', 4),
+                      (10, b'\x01\x02', None), (12, b'\x03\x09\x09', None)])
+    self.assertEqual(merged.labels, ["map", "map", "fixes", "speed_hacks"])
+
+    with self.assertRaises(self.ips.PatchConflict) as raised:
+      patch.merge(strict=True)
+    self.assertEqual((raised.exception.start, raised.exception.end,
+                      raised.exception.label,
+                      raised.exception.overwritten_label),
+                     (13, 14, "speed_hacks", "fixes"))
+
+  def test_merge_conflicts_at_the_same_address(self):
+    patch = self.ips.Patch(label="fixes")
+    patch.add_record(0xff64, b'\x01\x02\x03\x04')
+    patch.add_record(0x100, 7, 3)
+    patch.label = "death_necklace"
+    patch.add_record(0xff64, b'\x01\x09\x09')
+    patch.add_record(0x100, 7)
+    # the records are still replaced in place, so the encoding is unchanged
+    self.assertEqual([(r.address, bytes(r.content), r.rle_size)
+                      for r in patch.records],
+                     [(0xff64, b'\x01\x09\x09', None), (0x100, b'\x07', 3)])
+
+    conflicts = []
+    merged = patch.merge(conflicts)
+    self.assertEqual(conflicts, [(0xff65, 0xff67, "death_necklace", "fixes")])
+    self.assertEqual(merged.apply(bytes(0x10000)), patch.apply(bytes(0x10000)))
+    with self.assertRaises(self.ips.PatchConflict):
+      patch.merge(strict=True)
+
+    # combined and copied patches keep the replaced content
+    combined = self.ips.Patch()
+    combined.add_record(0, b'\x00')
+    combined.combine(patch)
+    for other in (combined, patch.copy()):
+      conflicts = []
+      other.merge(conflicts)
+      self.assertEqual(conflicts,
+                       [(0xff65, 0xff67, "death_necklace", "fixes")])
+
+  def test_records_change_the_patch(self):
+    patch = self.ips.Patch()
+    patch.add_record(4, b'abc')
+    patch.add_record(12, b'x', 3)
+    patch.append_content(4, b'z')
+    self.assertEqual(patch.sha1(), self.ips.Patch(patch.encode()).sha1())
+
+    patch.records[0].content = b'abcd'
+    patch.records[1].rle_size = 5
+    patch.records[1].set_content(b'y')
+    self.assertEqual(patch.apply(bytes(20)),
+                     bytes(4) + b'zbcd' + bytes(4) + b'yyyyy' + bytes(3))
+    self.assertEqual([record.encode() for record in patch.records],
+                     [self.ips.Record(4, b'abcd').encode(),
+                      self.ips.Record(12, b'y', 5).encode(),
+                      self.ips.Record(4, b'z').encode()])
+    self.assertEqual(patch.sha1(), self.ips.Patch(patch.encode()).sha1())
+
+    # the content returned is a copy
+    patch.records[0].content[0] = 0
+    self.assertEqual(bytes(patch.records[0].content), b'abcd')
+
+    # add_record finds records by their new address
+    patch.records[0].set_addr(0)
+    patch.add_record(0, b'A')
+    patch.add_record(4, b'Z')
+    self.assertEqual([(r.address, bytes(r.content)) for r in patch.records],
+                     [(0, b'A'), (12, b'y'), (4, b'Z')])
+    with self.assertRaises(ValueError):
+      patch.records[1].content = b'yy'
+
+  def test_bps_round_trip(self):
+    rng = random.Random(6)
+    for _ in range(100):
+      orig = rng.randbytes(rng.randint(1, 2000))
+      patched = random_change(rng, orig, grow=rng.choice((0, 30)))
+      if rng.random() < 0.2:
+        patched = patched[:rng.randrange(len(patched))]
+      metadata = rng.randbytes(rng.randint(0, 4))
+      patch = self.ips.create_bps(orig, patched, metadata)
+      self.assertEqual(self.ips.apply_bps(orig, patch), patched)
+
+  def test_bps_copies_moved_data(self):
+    rng = random.Random(7)
+    orig = rng.randbytes(4096)
+    patched = orig[2048:] + orig[:2048]
+    patch = self.ips.create_bps(orig, patched)
+    self.assertEqual(self.ips.apply_bps(orig, patch), patched)
+    self.assertLess(len(patch), 64)
+
+  def test_bps_checks_crcs(self):
+    orig, patched = bytes(range(200)), bytes(range(100, 250))
+    patch = self.ips.create_bps(orig, patched)
+    with self.assertRaises(ValueError):
+      self.ips.apply_bps(orig[:-1] + b'x', patch)
+    corrupt = bytearray(patch)
+    corrupt[6] ^= 1
+    with self.assertRaises(ValueError):
+      self.ips.apply_bps(orig, corrupt)
+    with self.assertRaises(ValueError):
+      self.ips.apply_bps(orig, b'PATCHEOF')
+
+  def test_command_line_bps_patch_of_a_smaller_file(self):
+    rng = random.Random(9)
+    orig = rng.randbytes(5000)
+    with tempfile.TemporaryDirectory() as directory:
+      names = [os.path.join(directory, name) for name in ("a", "b", "c")]
+      for name, content in zip(names, (orig, orig[:3000])):
+        with open(name, 'wb') as output_file:
+          output_file.write(content)
+      printed = io.StringIO()
+      argv = ["ips", "--format", "bps", names[0], names[1]]
+      with mock.patch.object(sys, 'argv', argv), \
+           contextlib.redirect_stdout(printed):
+        self.ips.main()
+      self.assertNotIn("IPS patch", printed.getvalue())
+      with open(names[1] + ".bps", 'rb') as patch_file:
+        self.assertEqual(self.ips.apply_bps(orig, patch_file.read()),
+                         orig[:3000])
+
+
+class ToolsIpsTests(IpsTests, unittest.TestCase):
+  ips = load_ips("tools")
+
+
+class LegacyIpsTests(IpsTests, unittest.TestCase):
+  ips = load_ips("legacy")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 
+import os
+import mmap
+import shutil
 import struct
 import argparse
+import hashlib
+import heapq
+import zlib
+import contextlib
+from array import array
 
 def create_ips(file1_content, file2_content):
   """
@@ -31,44 +39,366 @@ def apply_ips(file_content, patch_content):
   rtype: bytearray
   return: The patched content of the binary file
   """
-  patch = Patch(patch_content)
-  return patch.apply(file_content)
+  return apply_records(patch_content, file_content)
+
+def read_records(ips_content):
+  """
+  Reads the records of an ips patch one at a time, without copying the
+  content of each record when the patch is already in memory.
+
+  :Parameters:
+    ips_content : bytes
+      The contents of the ips patch, or a file object to read it from. A
+      file is read up to the EOF marker; otherwise the marker must be the
+      last 3 bytes.
+
+  rtype: generator
+  return: An (address, content, rle_size) tuple for each record. content is
+    a memoryview, and rle_size is None unless this is an RLE record.
+  """
+  if hasattr(ips_content, 'read'):
+    if ips_content.read(5) != b'PATCH':
+      raise ValueError("Not an IPS patch")
+    while True:
+      header = ips_content.read(3)
+      if header == b'EOF':
+        return
+      address = int.from_bytes(header, 'big')
+      size, = struct.unpack(">H", ips_content.read(2))
+      if size:
+        yield address, memoryview(ips_content.read(size)), None
+      else: #run length encoded
+        size, = struct.unpack(">H", ips_content.read(2))
+        yield address, memoryview(ips_content.read(1)), size
+
+  data = memoryview(ips_content)
+  if data[:5] != b'PATCH' or data[-3:] != b'EOF':
+    raise ValueError("Not an IPS patch")
+  ips_ptr = 5
+  while ips_ptr < len(data) - 3:
+    bank, address, size = struct.unpack_from(">BHH", data, ips_ptr)
+    ips_ptr += 5
+    if size:
+      yield bank << 16 | address, data[ips_ptr:ips_ptr+size], None
+      ips_ptr += size
+    else: #run length encoded
+      size, = struct.unpack_from(">H", data, ips_ptr)
+      yield bank << 16 | address, data[ips_ptr+2:ips_ptr+3], size
+      ips_ptr += 3
+
+def apply_records(ips_content, orig_content):
+  """
+  Applies an ips patch as its records are read, without creating a Patch.
+
+  :Parameters:
+    ips_content : bytes
+      The contents of the ips patch, or a file object to read it from.
+    orig_content : bytearray
+      The content to apply the patch to. It is changed in place if it is a
+      bytearray, otherwise it is copied first.
+
+  rtype: bytearray
+  return: The patched content
+  """
+  if not isinstance(orig_content, bytearray):
+    orig_content = bytearray(orig_content)
+  for address, content, rle_size in read_records(ips_content):
+    if rle_size:
+      orig_content[address:address+rle_size] = bytes(content) * rle_size
+    else:
+      orig_content[address:address+len(content)] = content
+  return orig_content
+
+# the actions of a bps patch
+BPS_SOURCE_READ, BPS_TARGET_READ, BPS_SOURCE_COPY, BPS_TARGET_COPY = range(4)
+
+def create_bps(orig_content, patched_content, metadata=b''):
+  """
+  Creates a bps patch from the content of 2 files. Unlike an ips patch, a
+  bps patch can copy data from elsewhere in the original file or from
+  earlier in the patched file, and is checked with CRC32 checksums.
+
+  :Parameters:
+    orig_content : bytes
+      The content of the original file.
+    patched_content : bytes
+      The content of the modified file.
+    metadata : bytes
+      Optional. Metadata to store in the patch.
+
+  rtype: bytearray
+  return: The content of the new bps file.
+  """
+  source, target = orig_content, patched_content
+  out = bytearray(b'BPS1')
+  out += bps_number(len(source)) + bps_number(len(target))
+  out += bps_number(len(metadata)) + metadata
+  index = None
+  source_rel = target_rel = 0
+  pos = 0
+  for start, end in bps_regions(source, target):
+    # a copy may have run past the start of this region
+    start = max(start, pos)
+    if start >= end:
+      continue
+    if start > pos:
+      out += bps_number((start - pos - 1) << 2 | BPS_SOURCE_READ)
+    # copy the region from the original or the patched file where that is
+    # smaller than its content, which is added for the rest.
+    literal = i = start
+    while i < end:
+      if i > 0 and target[i] == target[i-1]:
+        # a target copy from the previous byte repeats it
+        n = 1
+        while i + n < end and target[i+n] == target[i-1]:
+          n += 1
+        action = (bps_number((n - 1) << 2 | BPS_TARGET_COPY) +
+                  bps_offset(i - 1 - target_rel))
+        if len(action) < n:
+          out += bps_literal(target, literal, i) + action
+          target_rel = i - 1 + n
+          i = literal = i + n
+          continue
+      if index is None:
+        index = bps_index(source)
+      src = index.get(bytes(target[i:i+8]))
+      if src is not None:
+        n = 8
+        while (i + n < end and src + n < len(source) and
+               source[src+n] == target[i+n]):
+          n += 1
+        back = 0
+        while (i - back > literal and src - back > 0 and
+               source[src-back-1] == target[i-back-1]):
+          back += 1
+        action = (bps_number((n + back - 1) << 2 | BPS_SOURCE_COPY) +
+                  bps_offset(src - back - source_rel))
+        if len(action) < n + back:
+          out += bps_literal(target, literal, i - back) + action
+          source_rel = src + n
+          i = literal = i + n
+          continue
+      i += 1
+    out += bps_literal(target, literal, end)
+    pos = i
+  if len(target) > pos:
+    out += bps_number((len(target) - pos - 1) << 2 | BPS_SOURCE_READ)
+  out += struct.pack('<II', zlib.crc32(source), zlib.crc32(target))
+  out += struct.pack('<I', zlib.crc32(out))
+  return out
+
+def apply_bps(file_content, patch_content):
+  """
+  Applies a bps patch to the given file
+
+  :Parameters:
+    file_content : bytes
+      The content of the original file
+    patch_content : bytes
+      The content of the bps patch
+
+  rtype: bytearray
+  return: The patched content
+  """
+  patch = memoryview(patch_content)
+  if patch[:4] != b'BPS1' or len(patch) < 16:
+    raise ValueError("Not a BPS patch")
+  source_crc, target_crc, patch_crc = struct.unpack('<III', patch[-12:])
+  if zlib.crc32(patch[:-4]) != patch_crc:
+    raise ValueError("The BPS patch is corrupt.")
+  if zlib.crc32(file_content) != source_crc:
+    raise ValueError("The BPS patch is not for this file.")
+  source_size, ptr = read_bps_number(patch, 4)
+  target_size, ptr = read_bps_number(patch, ptr)
+  metadata_size, ptr = read_bps_number(patch, ptr)
+  ptr += metadata_size
+  target = bytearray(target_size)
+  pos = source_rel = target_rel = 0
+  while ptr < len(patch) - 12:
+    data, ptr = read_bps_number(patch, ptr)
+    action, length = data & 3, (data >> 2) + 1
+    if action == BPS_SOURCE_READ:
+      target[pos:pos+length] = file_content[pos:pos+length]
+    elif action == BPS_TARGET_READ:
+      target[pos:pos+length] = patch[ptr:ptr+length]
+      ptr += length
+    else:
+      data, ptr = read_bps_number(patch, ptr)
+      offset = -(data >> 1) if data & 1 else data >> 1
+      if action == BPS_SOURCE_COPY:
+        source_rel += offset
+        target[pos:pos+length] = file_content[source_rel:source_rel+length]
+        source_rel += length
+      else:
+        # the copy may overlap the bytes it writes, repeating the bytes
+        # between the two positions
+        target_rel += offset
+        repeat = target[target_rel:pos]
+        target[pos:pos+length] = (repeat * (length // len(repeat) + 1))[:length]
+        target_rel += length
+    pos += length
+  if zlib.crc32(target) != target_crc:
+    raise ValueError("The BPS patch did not produce the expected file.")
+  return target
+
+def bps_regions(orig_content, patched_content):
+  """
+  Finds the regions of the patched file which differ from the original.
+  Differences up to 2 bytes apart share a region, since reading the bytes
+  between them from the original would take at least as many bytes.
+
+  rtype: generator
+  return: A (start, end) tuple for each region.
+  """
+  start = end = None
+  for i in diff_offsets(orig_content, patched_content):
+    if end is not None and i - end > 2:
+      yield start, end
+      start = None
+    if start is None:
+      start = i
+    end = i + 1
+  if start is not None:
+    yield start, end
+
+def bps_index(content):
+  """
+  Indexes the 8 byte blocks of content, for finding bytes to copy from it.
+
+  rtype: dict
+  return: The offset of the first block holding each 8 bytes.
+  """
+  index = {}
+  for i in range(0, len(content) - 7, 8):
+    index.setdefault(bytes(content[i:i+8]), i)
+  return index
+
+def bps_literal(content, start, end):
+  """
+  Encodes a bps action adding content[start:end] to the patched file, or
+  nothing if the range is empty.
+  """
+  if start >= end:
+    return b''
+  return (bps_number((end - start - 1) << 2 | BPS_TARGET_READ) +
+          content[start:end])
+
+def bps_number(number):
+  """
+  Encodes a number in the variable length format used by bps patches.
+
+  rtype: bytearray
+  return: The encoded number.
+  """
+  out = bytearray()
+  while True:
+    byte = number & 0x7f
+    number >>= 7
+    if not number:
+      out.append(0x80 | byte)
+      return out
+    out.append(byte)
+    number -= 1
+
+def bps_offset(offset):
+  """
+  Encodes a signed offset in the variable length format used by bps patches.
+  """
+  return bps_number(abs(offset) << 1 | (offset < 0))
+
+def read_bps_number(content, ptr):
+  """
+  Reads a number in the variable length format used by bps patches.
+
+  rtype: tuple
+  return: The number and the offset after it.
+  """
+  number, shift = 0, 1
+  while True:
+    byte = content[ptr]
+    ptr += 1
+    number += (byte & 0x7f) * shift
+    if byte & 0x80:
+      return number, ptr
+    shift <<= 7
+    number += shift
 
 class Patch:
   """
-  A class for creating ips patch files
+  A class for creating ips patch files. Records are stored in parallel
+  columns, with their content packed into one payload, rather than as
+  separate Record objects.
   """
-  def __init__(self, ips_content=None):
+  def __init__(self, ips_content=None, label=None):
     """
     Creates a new patch object
     
     :Parameters:
       ips_content : bytearray
-        Optional. The contents of the ips patch to use for initialization.
-        Creates an empty patch if omitted.
-    """
-    self.records = []
-    if ips_content and ips_content[:5] == b'PATCH' and ips_content[-3:] == b'EOF':
-      # trim 'PATCH' from the beginning and 'EOF' from the end.
-      ips_ptr = 0
-      ips_content = ips_content[5:-3]
-      # parse the patches
-      while (ips_ptr < len(ips_content)):
-        record_meta = struct.unpack_from(">BHH", ips_content, ips_ptr)
-        ips_ptr += 5
-        record_addr = record_meta[0] << 16 | record_meta[1]
-        record_size = record_meta[2]
-        if record_size:
-          record_content = struct.unpack_from("B" * record_size, ips_content, 
-              ips_ptr)
-          ips_ptr += record_size
-          self.records.append(Record(record_addr, record_content))
-        else: #run length encoded
-          record_size = struct.unpack_from(">H", ips_content, ips_ptr)[0]
-          ips_ptr += 2
-          record_content = struct.unpack_from("B", ips_content, ips_ptr)[0]
-          ips_ptr += 1
-          self.records.append(Record(record_addr, record_content, record_size))
+        Optional. The contents of the ips patch to use for initialization,
+        or a file object to read it from. Creates an empty patch if omitted.
+      label : str
+        Optional. The label given to the records added to this patch, such
+        as the name of the code adding them. See merge.
+    """
+    self.clear()
+    self.label = label
+    if hasattr(ips_content, 'read') or (ips_content and
+        ips_content[:5] == b'PATCH' and ips_content[-3:] == b'EOF'):
+      for address, content, rle_size in read_records(ips_content):
+        self.append_content(address, content, rle_size)
+
+  @property
+  def records(self):
+    """
+    A sequence of the records in this patch. Each one is a PatchRecord, so
+    changing it changes the patch.
+    """
+    return Records(self)
+
+  def record(self, i):
+    """
+    Returns the i'th record of this patch.
+
+    :Parameters:
+      i : int
+        The number of the record.
+
+    rtype: PatchRecord
+    return: The record, which reads and writes the columns of this patch.
+    """
+    return PatchRecord(self, i)
+
+  def set_record(self, i, address, content, rle_size=None):
+    """
+    Replaces the i'th record of this patch, keeping its label. Used by
+    PatchRecord.
+
+    :Parameters:
+      i : int
+        The number of the record.
+      address : int
+        The address where the content is to be applied.
+      content : array or int
+        The content of the record, as for add_record.
+      rle_size : int
+        Optional, only for run length encoded records.
+    """
+    content = record_content(content, rle_size)
+    old_address = self.addresses[i]
+    if address != old_address:
+      self.addresses[i] = address
+      if self.index[old_address] == i:
+        # the next record at the old address, if any, is now the first
+        del self.index[old_address]
+        for j in range(i + 1, len(self.addresses)):
+          if self.addresses[j] == old_address:
+            self.index[old_address] = j
+            break
+      if self.index.get(address, i + 1) > i:
+        self.index[address] = i
+    self.rle_sizes[i] = rle_size or 0
+    self.write_content(i, content)
     
   def apply(self, orig_content):
     """
@@ -81,12 +411,35 @@ class Patch:
     rtype: bytearray
     return: The patched content
     """
-    if not isinstance(orig_content, bytearray):
+    if not isinstance(orig_content, (bytearray, mmap.mmap)):
       orig_content = bytearray(orig_content)
-    for record in self.records:
-      record.apply(orig_content)
+    with memoryview(self.payload) as payload:
+      for address, offset, size, rle_size in zip(self.addresses, self.offsets,
+                                                 self.sizes, self.rle_sizes):
+        if rle_size:
+          orig_content[address:address+rle_size] = \
+              bytes(payload[offset:offset+1]) * rle_size
+        elif size:
+          orig_content[address:address+size] = payload[offset:offset+size]
     return orig_content
 
+  def apply_file(self, filename):
+    """
+    Applies this patch to a file in place. The file is memory-mapped, so only
+    the pages the records write to are read and written back. If records
+    extend past the end of the file, it is first extended with zeros.
+
+    :Parameters:
+      filename : str
+        The name of the file to patch.
+    """
+    end = max((address + (rle_size or size) for address, size, rle_size in
+               zip(self.addresses, self.sizes, self.rle_sizes)), default=0)
+    if os.path.getsize(filename) < end:
+      os.truncate(filename, end)
+    with map_file(filename, write=True) as content:
+      self.apply(content)
+
   def encode(self):
     """
     Encodes the Patch into ips format.
@@ -94,8 +447,46 @@ class Patch:
     rtype: bytearray
     return: The content of the new ips file.
     """
-    encoded =  b''.join([r.encode() for r in self.records])
-    return b''.join((b'PATCH', encoded, b'EOF'))
+    # records keep their encoding until they change, so only the changed
+    # ones are encoded again.
+    if self.encoded is None:
+      for i, part in enumerate(self.parts):
+        if part is None:
+          self.parts[i] = self.encode_record(i)
+      self.encoded = b''.join([b'PATCH'] + self.parts + [b'EOF'])
+      self.digest = None
+    return self.encoded
+
+  def encode_record(self, i):
+    """
+    Encodes the i'th record of this patch into ips format.
+
+    :Parameters:
+      i : int
+        The number of the record.
+
+    rtype: bytes
+    return: The ips-encoded record.
+    """
+    address, offset = self.addresses[i], self.offsets[i]
+    if self.rle_sizes[i]: #RLE record
+      return struct.pack('>BHHHB', address >> 16, address & 0xffff, 0,
+        self.rle_sizes[i], self.payload[offset])
+    return struct.pack('>BHH', address >> 16, address & 0xffff,
+        self.sizes[i]) + self.payload[offset:offset+self.sizes[i]]
+
+  def sha1(self):
+    """
+    Returns the sha1 checksum of the encoded patch. Like the encoding, this
+    is only computed again after the patch changes.
+
+    rtype: str
+    return: The hex digest of the encoded patch.
+    """
+    encoded = self.encode()
+    if self.digest is None:
+      self.digest = hashlib.sha1(encoded).hexdigest()
+    return self.digest
 
   def add_record(self, address, content, rle_size=None):
     """
@@ -112,11 +503,76 @@ class Patch:
         Optional, only for run length encoded records. If creating an RLE
         record, content should be a single int, and this indicates the length.
     """
-    for r in self.records:
-      if r.address == address:
-        r.set_content(content)
-        return
-    self.records.append(Record(address, content, rle_size))
+    i = self.index.get(address)
+    if i is None:
+      self.append_content(address, record_content(content, rle_size), rle_size)
+      return
+    content = record_content(content, self.rle_sizes[i])
+    if self.labels[i] != self.label:
+      # keep the content written with the other label, so merge can report
+      # the conflict
+      offset = self.offsets[i]
+      self.replaced.append((i, address,
+          bytes(self.payload[offset:offset+self.sizes[i]]),
+          self.rle_sizes[i], self.labels[i]))
+    self.labels[i] = self.label
+    self.write_content(i, content)
+
+  def write_content(self, i, content):
+    """
+    Replaces the content of the i'th record of this patch.
+
+    :Parameters:
+      i : int
+        The number of the record.
+      content : bytearray
+        The new content.
+    """
+    if len(content) > self.sizes[i]:
+      # the old content is left unused in the payload
+      self.offsets[i] = len(self.payload)
+      self.payload += content
+    else:
+      self.payload[self.offsets[i]:self.offsets[i]+len(content)] = content
+    self.sizes[i] = len(content)
+    self.parts[i] = None
+    self.encoded = None
+
+  def append(self, record):
+    """
+    Adds a record to the end of this patch, even if another record has the
+    same address.
+
+    :Parameters:
+      record : Record
+        The record to be added.
+    """
+    self.append_content(record.address, record.content or b'', record.rle_size)
+
+  def append_content(self, address, content, rle_size=None):
+    """
+    Adds a record to the end of this patch, even if another record has the
+    same address. The record is given the current label of the patch.
+
+    :Parameters:
+      address : int
+        The address where the content is to be applied.
+      content : bytes
+        The content of the record, which must be a single byte for an RLE
+        record.
+      rle_size : int
+        Optional, only for run length encoded records.
+    """
+    if address not in self.index:
+      self.index[address] = len(self.addresses)
+    self.addresses.append(address)
+    self.offsets.append(len(self.payload))
+    self.sizes.append(len(content))
+    self.rle_sizes.append(rle_size or 0)
+    self.payload += content
+    self.labels.append(self.label)
+    self.parts.append(None)
+    self.encoded = None
 
   def add_records(self, patchdict):
     """
@@ -134,7 +590,19 @@ class Patch:
     """
     Clears all records from this patch.
     """
-    self.records = []
+    self.addresses = array('I')
+    self.offsets = array('I') # where each record's content is in payload
+    self.sizes = array('I') # the length of each record's content
+    self.rle_sizes = array('I') # the length of each RLE record, or 0
+    self.payload = bytearray()
+    self.index = {} # the number of the first record at each address
+    self.labels = [] # the label of the patch when each record was added
+    # (record, address, content, rle_size, label) for each record whose
+    # content add_record replaced with content with another label
+    self.replaced = []
+    self.parts = [] # the encoding of each record, or None if it changed
+    self.encoded = None
+    self.digest = None
 
   def combine(self, patch):
     """
@@ -144,24 +612,306 @@ class Patch:
     patch : Patch
       The Patch to be combined with this one.
     """
-    self.records = self.records + patch.records
+    for address, i in patch.index.items():
+      if address not in self.index:
+        self.index[address] = len(self.addresses) + i
+    self.replaced.extend((i + len(self.addresses), address, content, rle_size,
+                          label) for i, address, content, rle_size, label
+                         in patch.replaced)
+    base = len(self.payload)
+    self.addresses.extend(patch.addresses)
+    self.offsets.extend(offset + base for offset in patch.offsets)
+    self.sizes.extend(patch.sizes)
+    self.rle_sizes.extend(patch.rle_sizes)
+    self.payload += patch.payload
+    self.labels.extend(patch.labels)
+    self.parts.extend(patch.parts)
+    self.encoded = None
 
-  def clear(self):
-    self.records = []
+  def copy(self):
+    """
+    Returns a copy of this patch whose records can be changed independently.
 
-  def combine(self, patch):
-    self.records = self.records + patch.records
+    rtype: Patch
+    return: The new patch.
+    """
+    p = Patch(label=self.label)
+    p.addresses = array('I', self.addresses)
+    p.offsets = array('I', self.offsets)
+    p.sizes = array('I', self.sizes)
+    p.rle_sizes = array('I', self.rle_sizes)
+    p.payload = bytearray(self.payload)
+    p.index = dict(self.index)
+    p.labels = list(self.labels)
+    p.replaced = list(self.replaced)
+    p.parts = list(self.parts)
+    p.encoded = self.encoded
+    p.digest = self.digest
+    return p
+
+  def merge(self, conflicts=None, strict=False):
+    """
+    Creates an equivalent patch whose records don't overlap. Where records
+    overlap, the bytes of the later one are kept, as they are by apply.
+    Each record of the new patch keeps the label of the record it came from.
+
+    :Parameters:
+      conflicts : list
+        Optional. A (start, end, label, overwritten_label) tuple is appended
+        to this list for each range where a record overwrites different
+        bytes written by a record with another label, including content
+        add_record replaced.
+      strict : bool
+        Optional. Raises a PatchConflict for the first such range instead.
+
+    rtype: Patch
+    return: The merged patch.
+    """
+    # the start and end of every record, with ends sorted before starts at
+    # the same address. The replaced content is numbered after the records;
+    # it is only used to find conflicts, and never written.
+    count = len(self.addresses)
+    events = []
+    for i, (address, size, rle_size) in enumerate(zip(self.addresses,
+        self.sizes, self.rle_sizes)):
+      if rle_size or size:
+        events.append((address, 1, i))
+        events.append((address + (rle_size or size), 0, i))
+    for i, (_, address, content, rle_size, _) in enumerate(self.replaced):
+      if rle_size or content:
+        events.append((address, 1, count + i))
+        events.append((address + (rle_size or len(content)), 0, count + i))
+    events.sort()
+
+    p = Patch()
+    active = [] # a heap of the records covering the current address
+    ended = set() # records that have ended but are still in the heap
+    replaced = set() # the replaced content covering the current address
+    piece = None # the record being copied and the range copied so far
+    found = []
+    pos = 0
+    for address, is_start, i in events:
+      while active and -active[0] in ended:
+        ended.remove(-heapq.heappop(active))
+      if address > pos and active:
+        top = -active[0]
+        if piece and piece[0] == top and piece[2] == pos:
+          piece[2] = address
+        else:
+          if piece:
+            self.merge_piece(p, *piece)
+          piece = [top, pos, address]
+        if conflicts is not None or strict:
+          # what the record was written over, latest first. Content replaced
+          # in a record comes just before the record.
+          under = [((-j, 1), -j) for j in active
+                   if -j != top and -j not in ended]
+          under += [((self.replaced[j-count][0], 0), j) for j in replaced
+                    if self.replaced[j-count][0] <= top]
+          under.sort(reverse=True)
+          for j, start, end in self.overwritten(top, [j for _, j in under],
+                                                pos, address):
+            if strict:
+              raise PatchConflict(start, end, self.labels[top],
+                                  self.written_label(j))
+            found.append((start, end, self.labels[top],
+                          self.written_label(j)))
+      if i >= count:
+        if is_start:
+          replaced.add(i)
+        else:
+          replaced.discard(i)
+      elif is_start:
+        heapq.heappush(active, -i)
+      else:
+        ended.add(i)
+      pos = address
+    if piece:
+      self.merge_piece(p, *piece)
+
+    # join the conflicts between the same labels that are next to each other
+    joined = []
+    last = {}
+    for start, end, label, overwritten_label in found:
+      j = last.get((label, overwritten_label))
+      if j is not None and joined[j][1] == start:
+        joined[j][1] = end
+      else:
+        last[(label, overwritten_label)] = len(joined)
+        joined.append([start, end, label, overwritten_label])
+    if conflicts is not None:
+      conflicts.extend(tuple(conflict) for conflict in joined)
+    p.label = self.label
+    return p
+
+  def merge_piece(self, patch, i, start, end):
+    """
+    Adds the part of the i'th record from start to end to another patch,
+    with the label of the record. Used by merge.
+    """
+    patch.label = self.labels[i]
+    if self.rle_sizes[i]:
+      offset = self.offsets[i]
+      patch.append_content(start, self.payload[offset:offset+1], end - start)
+    else:
+      patch.append_content(start, self.record_bytes(i, start, end))
+
+  def record_bytes(self, i, start, end):
+    """
+    Returns the bytes the i'th record of this patch writes from start to end.
+    The record must cover that range.
+
+    rtype: bytearray
+    return: The bytes written.
+    """
+    offset = self.offsets[i]
+    if self.rle_sizes[i]:
+      return self.payload[offset:offset+1] * (end - start)
+    offset += start - self.addresses[i]
+    return self.payload[offset:offset+end-start]
+
+  def written_label(self, j):
+    """
+    Returns the label of the j'th record, or of replaced content numbered
+    after the records. Used by merge.
+    """
+    if j < len(self.addresses):
+      return self.labels[j]
+    return self.replaced[j-len(self.addresses)][4]
+
+  def written_bytes(self, j, start, end):
+    """
+    Returns the bytes the j'th record, or replaced content numbered after the
+    records, writes from start to end. Used by merge.
+    """
+    if j < len(self.addresses):
+      return self.record_bytes(j, start, end)
+    _, address, content, rle_size, _ = self.replaced[j-len(self.addresses)]
+    if rle_size:
+      return content * (end - start)
+    return content[start-address:end-address]
+
+  def overwritten(self, i, under, start, end):
+    """
+    Yields a (record, start, end) tuple for each range between start and end
+    where the i'th record overwrites different bytes written with another
+    label. under holds the records and replaced content it was written over,
+    latest first. Used by merge.
+    """
+    content = None
+    for j in under:
+      if self.written_label(j) == self.labels[i]:
+        continue
+      if content is None:
+        content = self.record_bytes(i, start, end)
+      other = self.written_bytes(j, start, end)
+      if content == other:
+        continue
+      run = None
+      for x, (a, b) in enumerate(zip(content, other)):
+        if a != b and run is None:
+          run = x
+        elif a == b and run is not None:
+          yield j, start + run, start + x
+          run = None
+      if run is not None:
+        yield j, start + run, end
+
+  def compact(self, orig_content=None):
+    """
+    Creates an equivalent patch with overlapping records resolved, nearby
+    records joined where that is smaller and runs of the same byte stored as
+    RLE records where that is smaller.
+
+    :Parameters:
+      orig_content : bytearray
+        Optional. The content the patch will be applied to. If given, the
+        new records may also cover unchanged bytes between the written ones,
+        and the new patch is only equivalent when applied to this content.
+
+    rtype: Patch
+    return: The new patch.
+    """
+    if not self.addresses:
+      return Patch()
+    start = min(self.addresses)
+    end = max(address + (rle_size or size) for address, size, rle_size in
+              zip(self.addresses, self.sizes, self.rle_sizes))
+    content = bytearray(end - start)
+    written = bytearray(end - start)
+    # later records overwrite earlier ones, as they do in apply
+    for address, offset, size, rle_size in zip(self.addresses, self.offsets,
+                                               self.sizes, self.rle_sizes):
+      address -= start
+      if rle_size:
+        size = rle_size
+        content[address:address+size] = self.payload[offset:offset+1] * size
+      elif size:
+        content[address:address+size] = self.payload[offset:offset+size]
+      written[address:address+size] = b'\x01' * size
+
+    # find the regions the new records may cover: the written bytes, and the
+    # unchanged bytes between them if those are known. Gaps of 8 bytes or
+    # more, the most joining two records can save, are never bridged.
+    regions = []
+    region_start = written.find(1)
+    while region_start >= 0:
+      region_end = written.find(0, region_start)
+      if region_end < 0:
+        region_end = len(written)
+      if (orig_content is not None and regions and
+          region_start - regions[-1][1] < 8 and
+          start + region_start <= len(orig_content)):
+        gap = slice(regions[-1][1], region_start)
+        content[gap] = orig_content[start+gap.start:start+gap.stop]
+        regions[-1][1] = region_end
+      else:
+        regions.append([region_start, region_end])
+      region_start = written.find(1, region_end)
+
+    p = Patch()
+    for region_start, region_end in regions:
+      for s, e, rle in segment(content, written, region_start, region_end):
+        p.add_span(start + s, content[s:e], rle)
+    return p
+
+  def add_span(self, address, content, rle=False):
+    """
+    Adds records for a span of content, split into records no larger than the
+    format allows.
+
+    :Parameters:
+      address : int
+        The address where the content is to be applied.
+      content : bytearray
+        The content to be added.
+      rle : bool
+        Whether to add RLE records. All bytes of content must then be equal.
+    """
+    for i in range(0, len(content), 0xffff):
+      if rle:
+        self.append_content(address + i, content[:1],
+                            min(0xffff, len(content) - i))
+      else:
+        self.append_content(address + i, content[i:i+0xffff])
 
   @staticmethod
-  def create(orig_content, patched_content):
+  def create(orig_content, patched_content, optimal=False):
     """
     Creates a new patch from the content of 2 files.
 
     :Parameters:
       orig_content : bytearray
-        The content of the original file.
+        The content of the original file. This may be memory-mapped; the
+        files are compared a block at a time, and only the differing
+        regions are copied.
       patched_content : bytearray
-        The content of the modified file.
+        The content of the modified file, which may be memory-mapped too.
+      optimal : bool
+        Optional. Choose the records with the smallest encoded size, using
+        RLE records where they help, rather than joining differences up to
+        5 bytes apart. The number of bytes this saves is stored in the
+        saved attribute of the new patch.
 
     rtype: Patch
     return: The newly created Patch
@@ -169,30 +919,258 @@ class Patch:
     p = Patch()
     if not len(orig_content) <= len(patched_content):
       raise ValueError("Original file is larger than patched file.")
+    offsets = diff_offsets(orig_content, patched_content)
+    if optimal:
+      offsets = list(offsets)
+    # differences up to 5 bytes apart share a record, split where it is
+    # longer than a record can be
     diff_start = -1
     diff_end = -1
-    for i in range(len(patched_content)):
-      if i >= len(orig_content) or not orig_content[i] == patched_content[i]:
-        if diff_start < 0:
-          diff_start = i
-        diff_end = i
-      if diff_end >= 0 and (i - diff_end >= 5 or i == len(patched_content) - 1):
-        p.add_record(diff_start, patched_content[diff_start:diff_end+1])
+    for i in offsets:
+      if diff_end >= 0 and i - diff_end > 5:
+        p.add_span(diff_start, patched_content[diff_start:diff_end+1])
         diff_start = -1
-        diff_end = -1
+      if diff_start < 0:
+        diff_start = i
+      diff_end = i
+    if diff_end >= 0:
+      p.add_span(diff_start, patched_content[diff_start:diff_end+1])
 
+    if optimal:
+      greedy_size = len(p.encode())
+      p = Patch()
+      i = 0
+      for start, end in diff_regions(patched_content, offsets):
+        # each region is segmented from a copy of its own content
+        content = patched_content[start:end]
+        required = bytearray(end - start)
+        while i < len(offsets) and offsets[i] < end:
+          required[offsets[i] - start] = 1
+          i += 1
+        for s, e, rle in segment(content, required, 0, end - start):
+          p.add_span(start + s, content[s:e], rle)
+      p.saved = greedy_size - len(p.encode())
     return p
 
+@contextlib.contextmanager
+def map_file(filename, write=False):
+  """
+  Memory-maps a file for the duration of a with statement, so that its
+  content is only read as it is used.
+
+  :Parameters:
+    filename : str
+      The name of the file.
+    write : bool
+      Optional. Map the file for writing; changes are written to the file.
+
+  rtype: mmap
+  return: The content of the file. An empty file can't be mapped, so an
+    empty bytearray is used for one instead.
+  """
+  with open(filename, 'r+b' if write else 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      yield bytearray()
+      return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if write
+                   else mmap.ACCESS_READ) as content:
+      yield content
+
+def diff_offsets(orig_content, patched_content, block_sizes=(4096, 64)):
+  """
+  Finds the offsets of the bytes which differ between two files. The files
+  are compared a block at a time, and only blocks which differ are compared
+  in smaller blocks, and finally byte by byte.
+
+  :Parameters:
+    orig_content : bytes
+      The content of the original file.
+    patched_content : bytes
+      The content of the modified file. Bytes past the end of the original
+      always differ.
+    block_sizes : tuple
+      The block sizes to compare with, from largest to smallest.
+
+  rtype: generator
+  return: The offsets of the differing bytes, in order.
+  """
+  for offset in diff_blocks(orig_content, patched_content, 0,
+                            len(patched_content), block_sizes):
+    if offset >= len(orig_content) or orig_content[offset] != patched_content[offset]:
+      yield offset
+
+def diff_blocks(orig_content, patched_content, start, end, block_sizes):
+  """
+  Finds the offsets in [start, end) which lie in differing blocks of the
+  smallest size in block_sizes.
+  """
+  if not block_sizes:
+    yield from range(start, end)
+    return
+  size = block_sizes[0]
+  for block in range(start, end, size):
+    block_end = min(end, block + size)
+    if orig_content[block:block_end] != patched_content[block:block_end]:
+      yield from diff_blocks(orig_content, patched_content, block, block_end,
+                             block_sizes[1:])
+
+def diff_regions(content, offsets):
+  """
+  Groups the offsets of differing bytes into regions which can be segmented
+  separately without making the patch any larger.
+
+  :Parameters:
+    content : bytes
+      The content of the modified file.
+    offsets : list
+      The offsets of the differing bytes, in order.
+
+  rtype: generator
+  return: A (start, end) tuple for each region.
+  """
+  start = end = None
+  for i in offsets:
+    if end is not None and i > end:
+      # joining two regions means covering the unchanged bytes between them.
+      # 8 of those that can't be added to an RLE record of the differing
+      # byte on either side cost at least as much as the header it saves.
+      gap = content[end:i].lstrip(content[end-1:end]).rstrip(content[i:i+1])
+      if len(gap) >= 8:
+        yield start, end
+        start = i
+    if start is None:
+      start = i
+    end = i + 1
+  if start is not None:
+    yield start, end
+
+def record_content(content, rle_size=None):
+  """
+  Converts the content given for a record to a bytearray.
+
+  :Parameters:
+    content : array or int
+      An array of bytes or ints, or a single int.
+    rle_size : int
+      The length of the record if it is run length encoded, in which case
+      content may only hold one byte.
+
+  rtype: bytearray
+  return: The content of the record.
+  """
+  try:
+    if len(content) > 1 and rle_size:
+      raise ValueError("RLE records may only contain one byte of content, "
+        "%d bytes provided" % len(content))
+    return bytearray(content)
+  except TypeError:
+    return bytearray((content,))
+
+def segment(content, required, start, end):
+  """
+  Chooses the records which cover the required bytes of content[start:end]
+  with the smallest encoded size. Bytes which aren't required may be covered
+  too, so their content must be what the patch will be applied over.
+
+  :Parameters:
+    content : bytearray
+      The content the records will hold.
+    required : bytearray
+      Nonzero for each byte of content which must be covered.
+    start : int
+      The offset of the first byte which may be covered.
+    end : int
+      The offset after the last byte which may be covered.
+
+  rtype: list
+  return: A (start, end, rle) tuple for each record, in order of address.
+  """
+  # cost[i] is the smallest size of records covering the required bytes
+  # before start + i, and choice[i] the last of those records as a
+  # (record start, rle) tuple, or None if byte start + i - 1 is left alone.
+  cost = [0] * (end - start + 1)
+  choice = [None] * (end - start + 1)
+  literal = (0, 0) # the best (cost[j] - j, j) to start a literal record from
+  run = (0, 0) # the best (cost[j], j) to start an RLE record from
+  for i in range(1, end - start + 1):
+    pos = start + i - 1
+    literal = min(literal, (cost[i-1] - (i-1), i-1))
+    if i == 1 or content[pos] != content[pos-1]:
+      run = (cost[i-1], i-1)
+    else:
+      run = min(run, (cost[i-1], i-1))
+    # a literal record costs 5 bytes plus its content, an RLE record 8 bytes
+    cost[i], choice[i] = literal[0] + i + 5, (literal[1], False)
+    if run[0] + 8 < cost[i]:
+      cost[i], choice[i] = run[0] + 8, (run[1], True)
+    if not required[pos] and cost[i-1] <= cost[i]:
+      cost[i], choice[i] = cost[i-1], None
+
+  segments = []
+  i = end - start
+  while i > 0:
+    if choice[i] is None:
+      i -= 1
+    else:
+      j, rle = choice[i]
+      segments.append((start + j, start + i, rle))
+      i = j
+  segments.reverse()
+  return segments
+
+class PatchConflict(ValueError):
+  """
+  Raised by Patch.merge when a record overwrites bytes written by a record
+  with another label.
+  """
+
+  def __init__(self, start, end, label, overwritten_label):
+    ValueError.__init__(self, "%s overwrites %s at 0x%x-0x%x" %
+        (label, overwritten_label, start, end - 1))
+    self.start = start
+    self.end = end
+    self.label = label
+    self.overwritten_label = overwritten_label
+
+class Records:
+  """
+  A sequence of the records in a Patch. Records can be changed through it,
+  but not added or removed.
+  """
+  __slots__ = ('patch',)
+
+  def __init__(self, patch):
+    self.patch = patch
+
+  def __len__(self):
+    return len(self.patch.addresses)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self.patch.record(j) for j in range(*i.indices(len(self)))]
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("record index out of range")
+    return self.patch.record(i)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self.patch.record(i)
+
 class Record:
   """
   A class for holding information about a Patch record.
   """
+  __slots__ = ('address', 'rle_size', 'content')
+
   def __init__(self, address, content=None, rle_size=None):
     """
     Creates a new patch record.
     """
     self.address = address 
     self.rle_size = rle_size #RLE records only
+    self.content = None
     if content is not None:
       self.set_content(content)
 
@@ -213,13 +1191,7 @@ class Record:
       content : bytearray
         The new content for this record.
     """
-    try:
-      if len(content) > 1 and self.rle_size:
-        raise ValueError("RLE records may only contain one byte of content, "
-          "%d bytes provided" % len(content))
-      self.content = bytearray(content)
-    except TypeError:
-      self.content = bytearray((content,))
+    self.content = record_content(content, self.rle_size)
 
   def size(self):
     """
@@ -245,8 +1217,8 @@ class Record:
     if self.rle_size: #RLE record
       return struct.pack('>BHHHB', self.address >> 16, self.address & 0xffff, 0,
         self.rle_size, int(self.content[0]))
-    return struct.pack('>BHH' + 'B' * self.size(), self.address >> 16, 
-        self.address & 0xffff, self.size(), *[int(b) for b in self.content])
+    return struct.pack('>BHH', self.address >> 16, self.address & 0xffff,
+        self.size()) + self.content
 
   def apply(self, orig_content):
     """
@@ -261,36 +1233,92 @@ class Record:
       orig_content[self.address:self.address+size] = self.content * size
     elif size:
       orig_content[self.address:self.address+size] = self.content
+
+class PatchRecord(Record):
+  """
+  A record of a Patch, returned by Patch.record. Its fields are read from
+  the patch when they are used, and setting them changes the patch. The
+  content is a copy, so changing it in place has no effect until it is
+  assigned back.
+  """
+  __slots__ = ('patch', 'i')
+
+  def __init__(self, patch, i):
+    self.patch = patch
+    self.i = i
+
+  @property
+  def address(self):
+    return self.patch.addresses[self.i]
+
+  @address.setter
+  def address(self, address):
+    self.patch.set_record(self.i, address, self.content, self.rle_size)
+
+  @property
+  def content(self):
+    offset = self.patch.offsets[self.i]
+    return self.patch.payload[offset:offset+self.patch.sizes[self.i]]
+
+  @content.setter
+  def content(self, content):
+    self.patch.set_record(self.i, self.address, content, self.rle_size)
+
+  @property
+  def rle_size(self):
+    return self.patch.rle_sizes[self.i] or None
+
+  @rle_size.setter
+  def rle_size(self, rle_size):
+    self.patch.set_record(self.i, self.address, self.content, rle_size)
+
+  def encode(self):
+    return self.patch.encode_record(self.i)
     
  
 def main():
   parser = argparse.ArgumentParser(prog="ips",
-      description="A utility for creating and appying IPS patches")
+      description="A utility for creating and appying IPS and BPS patches")
   parser.add_argument("-o","--output", type=str,
       help="The file name to be written.")
+  parser.add_argument("--optimal", action="store_true",
+      help="When creating a patch, choose the records with the smallest size.")
+  parser.add_argument("--format", choices=("ips", "bps"), default="ips",
+      help="The format of the patch to create. Creating a BPS patch also "
+           "reports how large the IPS patch would be, unless the second file "
+           "is smaller, which only a BPS patch can create.")
+  parser.add_argument("--in-place", action="store_true",
+      help="When applying a patch, patch the file itself instead of a copy.")
   parser.add_argument("file1", help="The first input file")
   parser.add_argument("file2", help="The second input file")
   args = parser.parse_args()
+  if args.in_place and args.output:
+    parser.error("--in-place and --output can't be used together.")
+
+  patch_name = None
 
-  patch_content = None
-
-  file1 = open(args.file1, 'rb')
-  file1_content = file1.read()
-  file1.close()
-  file2 = open(args.file2, 'rb')
-  file2_content = file2.read()
-  file2.close()
-
-  if file1_content[:5] == b'PATCH':
-    patch_content, patch_name = file1_content, args.file1
-    file_content, file_name = file2_content, args.file2
-  elif file2_content[:5] == b'PATCH':
-    patch_content, patch_name = file2_content, args.file2
-    file_content, file_name = file1_content, args.file1
+  with open(args.file1, 'rb') as file1:
+    file1_header = file1.read(5)
+  with open(args.file2, 'rb') as file2:
+    file2_header = file2.read(5)
+
+  if file1_header.startswith((b'PATCH', b'BPS1')):
+    patch_name, file_name = args.file1, args.file2
+  elif file2_header.startswith((b'PATCH', b'BPS1')):
+    patch_name, file_name = args.file2, args.file1
   
-  if patch_content:
-    out = apply_ips(file_content, patch_content)
-    if not args.output:
+  if patch_name:
+    with open(patch_name, 'rb') as patch_file:
+      if patch_file.read(4) == b'BPS1':
+        patch = None
+        patch_content = b'BPS1' + patch_file.read()
+      else:
+        patch_file.seek(0)
+        patch = Patch(patch_file)
+    # the patch is written into a copy of the file, or the file itself
+    if args.in_place:
+      args.output = file_name
+    elif not args.output:
       try:
         patch_name_without_ext = patch_name[:patch_name.rindex('.')]
       except ValueError:
@@ -300,10 +1328,36 @@ def main():
       except ValueError:
         ext = '.patched'
       args.output = patch_name_without_ext + ext
+    if patch is None:
+      # a bps patch may move data around, so the file is written again
+      with map_file(file_name) as file_content:
+        out = apply_bps(file_content, patch_content)
+    else:
+      if not args.in_place:
+        shutil.copyfile(file_name, args.output)
+      patch.apply_file(args.output)
+      return
   else:
-    out = create_ips(file1_content, file2_content)
+    with map_file(args.file1) as file1_content, \
+         map_file(args.file2) as file2_content:
+      out = None
+      # an ips patch can't shrink a file, so a bps patch is only compared
+      # with one when the second file is no smaller
+      if args.format == 'ips' or len(file1_content) <= len(file2_content):
+        patch = Patch.create(file1_content, file2_content, args.optimal)
+        if args.optimal:
+          print("Saved %d bytes over the default patch." % patch.saved)
+        out = patch.encode()
+      if args.format == 'bps':
+        ips_size = len(out) if out is not None else None
+        out = create_bps(file1_content, file2_content)
+        if ips_size is None:
+          print("BPS patch: %d bytes." % len(out))
+        else:
+          print("BPS patch: %d bytes, IPS patch: %d bytes." %
+                (len(out), ips_size))
     if not args.output:
-      args.output = args.file2 + '.ips'
+      args.output = args.file2 + '.' + args.format
   
   outfile = open(args.output, 'wb')
   outfile.write(out)